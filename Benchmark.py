@@ -0,0 +1,524 @@
+import argparse
+import asyncio
+import json
+import os
+import pickle
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+import Bot
+from Contacts import AddressBook, Record
+from Notes import Notes, Note
+from Suggestions import Suggester
+
+TAGS = ["work", "home", "family", "todo", "idea", "car", "birthday", "travel", "shop", "health"]
+SYLLABLES = ["an", "bo", "ca", "de", "el", "fi", "ga", "ho", "in", "ju", "ka", "lo", "ma", "ni", "or", "pe", "ra", "si", "ta", "vi"]
+
+
+def random_name(rnd: random.Random) -> str:
+    first = "".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 3))).title()
+    last = "".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))).title()
+    return f"{first} {last}"
+
+
+def generate_records(size: int, seed=42):
+    rnd = random.Random(seed)
+    names = set()
+    while len(names) < size:
+        name = random_name(rnd)
+        if name in names:
+            name = f"{name} {len(names)}"
+        names.add(name)
+        record = Record(name)
+        for _ in range(rnd.randint(1, 3)):
+            phone = f"{rnd.randrange(10**10):010d}"
+            if not record.find_phone(phone):
+                record.add_phone(phone)
+        if rnd.random() < 0.5:
+            record.add_birthday(f"{rnd.randint(1, 28)}-{rnd.randint(1, 12)}-{rnd.randint(1950, 2010)}")
+        yield record
+
+
+def build_book(size: int, seed=42) -> AddressBook:
+    book = AddressBook("benchmark.pkl")
+    for record in generate_records(size, seed):
+        book.add_record(record)
+    return book
+
+
+def generate_notes(size: int, seed=42):
+    rnd = random.Random(seed)
+    for i in range(size):
+        words = ["".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 3))) for _ in range(rnd.randint(5, 30))]
+        words += [f"#{tag}" for tag in rnd.sample(TAGS, rnd.randint(0, 3))]
+        rnd.shuffle(words)
+        yield Note(f"Note {i}", " ".join(words))
+
+
+def build_notes(size: int, seed=42) -> Notes:
+    notes = Notes("benchmark_notes.pkl")
+    for note in generate_notes(size, seed):
+        notes.add_note(note)
+    return notes
+
+
+def typo(rnd: random.Random, word: str) -> str:
+    idx = rnd.randrange(len(word) - 1)
+    if rnd.random() < 0.5:
+        return word[:idx] + word[idx + 1:]
+    return word[:idx] + word[idx + 1] + word[idx] + word[idx + 2:]
+
+
+def measure(func, *args, repeat=5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def per_op(func, queries: list, repeat=3) -> float:
+    return measure(lambda: [func(*query) for query in queries], repeat=repeat) / len(queries)
+
+
+def linear_search(book: AddressBook, term: str) -> list:
+    return [record for record in book.data.values() if record.is_matching(term)]
+
+
+def bench_search(sizes, terms):
+    print(f"{'contacts':>10} {'build s':>9} {'term':>10} {'linear ms':>10} {'indexed ms':>11} {'hits':>6}")
+    for size in sizes:
+        started = time.perf_counter()
+        book = build_book(size)
+        build = time.perf_counter() - started
+        for term in terms:
+            linear = measure(linear_search, book, term, repeat=3)
+            indexed = measure(book.search_contacts, term)
+            hits = len(book.search_contacts(term))
+            print(f"{size:>10} {build:>9.2f} {term:>10} {linear * 1000:>10.2f} {indexed * 1000:>11.3f} {hits:>6}")
+
+
+def bench_memory(sizes):
+    print(f"{'contacts':>10} {'memory MB':>10} {'bytes/rec':>10} {'pickle MB':>10} {'pickle b/rec':>12}")
+    for size in sizes:
+        records = list(generate_records(size))
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        copies = pickle.loads(pickle.dumps(records))
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        pickled = len(pickle.dumps(copies))
+        print(f"{size:>10} {used / 2**20:>10.1f} {used / size:>10.0f} {pickled / 2**20:>10.1f} {pickled / size:>12.0f}")
+
+
+def bench_shards(sizes, terms, max_workers: int = None):
+    from Shards import ShardedAddressBook
+    max_workers = max_workers or os.cpu_count() or 1
+    print(f"{'contacts':>10} {'workers':>8} {'term':>6} {'first ms':>9} {'scan ms':>9} {'speedup':>8} {'hits':>7}")
+    for size in sizes:
+        records = list(generate_records(size))
+        book = AddressBook("benchmark.pkl")
+        book.add_records(pickle.loads(pickle.dumps(records)))
+        single = {term: measure(book.search_contacts, term, repeat=3) for term in terms}
+        for term in terms:
+            print(f"{size:>10} {'-':>8} {term:>6} {'':>9} {single[term] * 1000:>9.1f} {1:>8.2f} {len(book.search_contacts(term)):>7}")
+        for workers in range(1, max_workers + 1):
+            sharded = ShardedAddressBook("benchmark.pkl", shards=workers, workers=workers, parallel_threshold=0)
+            sharded.add_records(pickle.loads(pickle.dumps(records)))
+            for term in terms:
+                # the first scan builds the shard layouts, and with workers ships them over
+                first = measure(sharded.search_contacts, term, repeat=1)
+                scan = measure(sharded.search_contacts, term, repeat=3)
+                hits = len(sharded.search_contacts(term))
+                print(f"{size:>10} {workers:>8} {term:>6} {first * 1000:>9.1f} {scan * 1000:>9.1f} {single[term] / scan:>8.2f} {hits:>7}")
+            sharded.close()
+
+
+def edit_script(size: int, seed=42) -> list:
+    rnd = random.Random(seed)
+    names = [f"Contact{idx}" for idx in range(size // 2)]
+    lines = [f"add {name} 050{rnd.randrange(10 ** 7):07d}" for name in names]
+    for _ in range(size - len(lines)):
+        name = rnd.choice(names)
+        if rnd.random() < 0.5:
+            lines.append(f"add {name} 067{rnd.randrange(10 ** 7):07d}")
+        else:
+            lines.append(f"birthday {name} {rnd.randint(1, 28)}-{rnd.randint(1, 12)}-{rnd.randint(1950, 2010)}")
+    return lines
+
+
+def run_script(directory: str, storage: str, lines: list) -> float:
+    script = Path(directory) / "script.txt"
+    script.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    started = time.perf_counter()
+    subprocess.run([sys.executable, str(Path(__file__).with_name("Bot.py")), "--storage", storage, "--autosave", "0", "--batch", str(script)],
+                   cwd=directory, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - started
+
+
+def bench_transactions(sizes, storages):
+    print(f"{'commands':>10} {'storage':>8} {'per command s':>14} {'one commit s':>13} {'speedup':>8}")
+    for size in sizes:
+        lines = edit_script(size)
+        for storage in storages:
+            with tempfile.TemporaryDirectory() as plain, tempfile.TemporaryDirectory() as batched:
+                per_command = run_script(plain, storage, lines)
+                # the same edits inside one transaction reach the storage as a single write
+                one_commit = run_script(batched, storage, ["begin", *lines, "commit"])
+            print(f"{size:>10} {storage:>8} {per_command:>14.2f} {one_commit:>13.2f} {per_command / one_commit:>8.2f}")
+
+
+def operator_queries(rnd: random.Random, names: list, count: int, write_ratio: float) -> list:
+    # operators repeat a small set of queries all day, with the odd change in between
+    pool = [("search_handler", ("contacts", name.split()[1][:4].lower())) for name in rnd.sample(names, 20)]
+    pool += [("search_handler", ("notes", f"#{tag}")) for tag in TAGS]
+    pool += [("show_handler", ("birthdays", days)) for days in (7, 30)]
+    queries = []
+    for i in range(count):
+        if rnd.random() < write_ratio:
+            queries.append(("add_handler", (f"Operator N{i}", f"{rnd.randrange(10**10):010d}")))
+        else:
+            queries.append(rnd.choice(pool))
+    return queries
+
+
+def bench_query_cache(sizes, count, write_ratio):
+    print(f"{'contacts':>10} {'uncached ms':>12} {'cached ms':>10} {'speedup':>8} {'hit rate':>9}")
+    for size in sizes:
+        Bot.records = build_book(size)
+        Bot.notes = build_notes(size // 10)
+        queries = operator_queries(random.Random(42), list(Bot.records.data.keys()), count, write_ratio)
+        timings = {}
+        for cache_size in (0, 256):
+            Bot.QUERY_CACHE.size = cache_size
+            Bot.QUERY_CACHE.clear()
+            # every run adds the same contacts, so each starts from the book it was built as
+            for name in [args[0] for handler, args in queries if handler == "add_handler"]:
+                Bot.records.delete(name)
+            started = time.perf_counter()
+            for handler, args in queries:
+                result = getattr(Bot, handler)(*args)
+                # the console pages through the whole result, and only a result read to the end is cached
+                if not isinstance(result, str):
+                    for _ in result:
+                        pass
+            timings[cache_size] = (time.perf_counter() - started) / count
+        stats = Bot.QUERY_CACHE.stats()
+        rate = stats["hits"] / max(stats["hits"] + stats["misses"], 1)
+        print(f"{size:>10} {timings[0] * 1000:>12.3f} {timings[256] * 1000:>10.3f} {timings[0] / timings[256]:>8.2f} {rate:>9.1%}")
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def client_commands(rnd: random.Random, names: list, client: int, count: int, write_ratio: float) -> list:
+    commands = []
+    for i in range(count):
+        if rnd.random() < write_ratio:
+            commands.append(f'add "Load Client{client} N{i}" {rnd.randrange(10**10):010d}')
+        elif rnd.random() < 0.5:
+            commands.append(f'phone "{rnd.choice(names)}"')
+        else:
+            commands.append(f"search {rnd.choice(names).split()[1][:4]}")
+    return commands
+
+
+async def run_client(host: str, port: int, commands: list, latencies: list):
+    from Server import PROMPT
+    reader, writer = await asyncio.open_connection(host, port, limit=2**24)
+    await reader.readuntil(PROMPT.encode())
+    for command in commands:
+        started = time.perf_counter()
+        writer.write(f"{command}\n".encode())
+        await reader.readuntil(PROMPT.encode())
+        latencies.append(time.perf_counter() - started)
+    writer.write(b"bye\n")
+    await reader.read()
+    writer.close()
+
+
+async def run_clients(host: str, port: int, workloads: list) -> list:
+    latencies = []
+    await asyncio.gather(*(run_client(host, port, commands, latencies) for commands in workloads))
+    return latencies
+
+
+def bench_server(sizes, clients, commands, write_ratio):
+    from Notes import Notes
+    from Server import BotServer
+    print(f"{'contacts':>10} {'clients':>8} {'commands':>9} {'cmd/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for size in sizes:
+        Bot.records = build_book(size)
+        Bot.notes = Notes("benchmark_notes.pkl")
+        names = list(Bot.records.data.keys())
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(BotServer(Bot.run_session, clients).start("127.0.0.1:0"))
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        host, port = server.sockets[0].getsockname()[:2]
+        rnd = random.Random(42)
+        workloads = [client_commands(rnd, names, client, commands, write_ratio) for client in range(clients)]
+        started = time.perf_counter()
+        latencies = asyncio.run(run_clients(host, port, workloads))
+        elapsed = time.perf_counter() - started
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        server.close()
+        print(f"{size:>10} {clients:>8} {len(latencies):>9} {len(latencies) / elapsed:>9.0f} {percentile(latencies, 0.5) * 1000:>8.2f} {percentile(latencies, 0.99) * 1000:>8.2f}")
+
+
+def suite_queries(rnd: random.Random, book: AddressBook, notes: Notes, count: int) -> dict:
+    names = rnd.sample(list(book.data.keys()), min(count, len(book.data)))
+    words = [word for note in rnd.sample(list(notes.data), min(count, len(notes.data))) for word in note.text.split() if not word.startswith("#")]
+    phones = [f"{rnd.randrange(10**4):04d}" for _ in range(count // 4)]
+    return {
+        "find": [(name,) for name in names] + [(f"Missing {i}",) for i in range(count // 10)],
+        "search_contacts": [(name.split()[rnd.randrange(2)][:4].lower(),) for name in names[:count // 2]] + [(phone,) for phone in phones] + [("ka",)] * (count // 20 or 1),
+        "get_contacts_by_birthdays": [(days,) for days in (1, 7, 30, 365)],
+        "search_notes": [(rnd.choice(words),) for _ in range(count // 4)]
+            + [(f"{rnd.choice(words)} {rnd.choice(words)}",) for _ in range(count // 4)]
+            + [(f"#{rnd.choice(TAGS)}",) for _ in range(count // 4)]
+            + [(f"{rnd.choice(words)} #{rnd.choice(TAGS)}",) for _ in range(count // 4)],
+        "notes_getitem": [(f"Note {rnd.randrange(len(notes.data))}",) for _ in range(count)],
+        "tag_stats": [(rnd.choice(TAGS),) for _ in range(count)],
+        "edit_note": [(f"Note {rnd.randrange(len(notes.data))}", f"{rnd.choice(words)} #{rnd.choice(TAGS)} #{rnd.choice(TAGS)}") for _ in range(count)],
+        "suggest_commands": [(typo(rnd, word),) for word in rnd.choices(["add", "change", "phone", "show", "delete", "birthday", "search", "note", "hello", "export"], k=count)],
+        "suggest_names": [(typo(rnd, name.split()[1].lower()),) for name in names],
+        "similar_names": [(typo(rnd, name),) for name in names],
+        "command_parser": [(line,) for line in rnd.choices([f'add "{names[0]}" 0501234567', "search kalo", "hello", "show birthdays 7", 'note "Shopping list" buy #car parts', f"phone {names[0]}", "delete note todo"], k=count)],
+    }
+
+
+def save_snapshot(storage, obj) -> None:
+    storage.compact(obj)
+    if hasattr(storage, "wait"):
+        storage.wait()
+
+
+FIRST_QUERIES = {
+    AddressBook: lambda book: book.search_contacts("kalo"),
+    Notes: lambda notes: list(notes.matching_titles("kalo")),
+}
+
+
+def load_and_query(loader: type, file_name: str, kind: str) -> None:
+    obj = loader(file_name).use_storage(loader.storage_class(kind)).deserialize()
+    FIRST_QUERIES[loader](obj)
+    obj.close()
+
+
+def bench_storage(book: AddressBook, notes: Notes, size: int, kind: str) -> list:
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for obj, loader in ((book, AddressBook), (notes, Notes)):
+            file_name = str(Path(directory) / f"{loader.__name__}.pkl")
+            storage = loader.storage_class(kind)(file_name)
+            saved = measure(lambda: save_snapshot(storage, obj), repeat=3)
+            storage.close()
+            loaded = measure(lambda: loader(file_name).use_storage(loader.storage_class(kind)).deserialize().close(), repeat=3)
+            # search indexes are built by the first query, so a load is only usable after both
+            queried = measure(lambda: load_and_query(loader, file_name, kind), repeat=3)
+            results.append({"benchmark": f"{loader.__name__}.serialize[{kind}]", "size": size, "seconds": saved, "bytes": storage.size()})
+            results.append({"benchmark": f"{loader.__name__}.deserialize[{kind}]", "size": size, "seconds": loaded})
+            results.append({"benchmark": f"{loader.__name__}.first_query[{kind}]", "size": size, "seconds": queried})
+    return results
+
+
+def bench_suite(sizes, storages, queries_per_op=200, seed=42) -> list:
+    results = []
+    print(f"{'benchmark':<36} {'size':>9} {'us/op':>12}")
+    for size in sizes:
+        rnd = random.Random(seed)
+        started = time.perf_counter()
+        book = build_book(size, seed)
+        notes = build_notes(size, seed)
+        built = time.perf_counter() - started
+        queries = suite_queries(rnd, book, notes, queries_per_op)
+        names_suggester = Suggester({name.split()[1].lower() for name in book.data.keys()}, cache_size=0)
+        commands_suggester = Suggester(set(Bot.COMMANDS.keys()).union(Bot.GREET_COMMANDS, Bot.EXIT_COMMANDS), cache_size=0)
+        operations = {
+            "find": lambda name: book.find(name, True),
+            "search_contacts": book.search_contacts,
+            "get_contacts_by_birthdays": lambda days: list(book.get_contacts_by_birthdays(days)),
+            "search_notes": lambda query: list(notes.search_notes(query)),
+            "notes_getitem": notes.__getitem__,
+            "tag_stats": lambda tag: (notes.tag_stats().frequency(tag), notes.tag_stats().related(tag), notes.tag_stats().recent(tag)),
+            "edit_note": notes.edit_note,
+            "suggest_commands": commands_suggester.suggest,
+            "suggest_names": names_suggester.suggest,
+            "similar_names": lambda name: book.similar_names(name, 1),
+            "command_parser": Bot.command_parser,
+        }
+        size_results = [{"benchmark": "build", "size": size, "seconds": built}]
+        for name, func in operations.items():
+            size_results.append({"benchmark": name, "size": size, "seconds": per_op(func, queries[name])})
+        for kind in storages:
+            size_results += bench_storage(book, notes, size, kind)
+        for result in size_results:
+            print(f"{result['benchmark']:<36} {size:>9} {result['seconds'] * 1_000_000:>12.1f}")
+        results += size_results
+    return results
+
+
+def legacy_command_parser(input: str) -> tuple:
+    # the shlex-on-every-line parser used before the dispatch table, kept as the baseline
+    clauses = []
+    command = ""
+    args = []
+    if input.lower() in Bot.GREET_COMMANDS:
+        command = "greet"
+    else:
+        clauses = shlex.split(input)
+        if clauses:
+            command = clauses[0]
+            if len(clauses) > 0:
+                args = clauses[1:]
+    if command.lower() in Bot.COMMANDS.keys():
+        return Bot.COMMANDS[command.lower()], args
+    return Bot.UNKNOWN_COMMAND, (command.lower(), args)
+
+
+PARSER_LINES = {
+    "plain": ["add bob 0501234567", "phone bob", "search kalo", "show birthdays 7", "change ann 0501234567 0507654321", "delete note todo"],
+    "quoted": ['add "Bob Marley" 0501234567', 'note "Shopping list" buy #car parts', "phone 'Ann Lee'"],
+    "greeting": ["hello", "good morning"],
+    "unknown": ["ad bob 0501234567", "shw"],
+}
+
+
+def bench_parser(repeat: int):
+    print(f"{'lines':<10} {'legacy us':>10} {'compiled us':>12} {'speedup':>8}")
+    for kind, lines in PARSER_LINES.items():
+        lines = lines * repeat
+        legacy = measure(lambda: [legacy_command_parser(line) for line in lines]) / len(lines)
+        compiled = measure(lambda: [Bot.command_parser(line) for line in lines]) / len(lines)
+        print(f"{kind:<10} {legacy * 1_000_000:>10.2f} {compiled * 1_000_000:>12.2f} {legacy / compiled:>8.1f}")
+
+
+def read_until(stream, marker: bytes) -> bytes:
+    output = b""
+    while not output.endswith(marker):
+        chunk = os.read(stream.fileno(), 65536)
+        if not chunk:
+            raise EOFError(f"the bot exited before printing {marker!r}")
+        output += chunk
+    return output
+
+
+def time_to_prompt(directory: str, flags: list) -> tuple:
+    started = time.perf_counter()
+    bot = subprocess.Popen([sys.executable, str(Path(__file__).with_name("Bot.py")), "--storage", "pickle", "--autosave", "0", *flags],
+                           cwd=directory, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    read_until(bot.stdout, b">>> ")
+    prompt = time.perf_counter() - started
+    # the first command reads a note, so a lazy start has to wait for the notes here if anywhere
+    bot.stdin.write(b'note "Note 0"\n')
+    bot.stdin.flush()
+    read_until(bot.stdout, b">>> ")
+    first_command = time.perf_counter() - started
+    bot.communicate(b"exit\n")
+    return prompt, first_command
+
+
+def bench_startup(sizes, repeat=3):
+    print(f"{'notes':>10} {'eager prompt ms':>16} {'lazy prompt ms':>15} {'eager first ms':>15} {'lazy first ms':>14}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            notes = build_notes(size)
+            with open(Path(directory) / "notes.pkl", "wb") as file:
+                pickle.dump(notes._get_state(), file)
+            eager = min(time_to_prompt(directory, []) for _ in range(repeat))
+            lazy = min(time_to_prompt(directory, ["--lazy-start"]) for _ in range(repeat))
+        print(f"{size:>10} {eager[0] * 1000:>16.1f} {lazy[0] * 1000:>15.1f} {eager[1] * 1000:>15.1f} {lazy[1] * 1000:>14.1f}")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline_path: str, threshold: float) -> list:
+    with open(baseline_path, encoding="utf-8") as file:
+        baseline = {(result["benchmark"], result["size"]): result["seconds"] for result in json.load(file)["results"]}
+    regressions = []
+    print(f"{'benchmark':<36} {'size':>9} {'baseline us':>12} {'current us':>12} {'ratio':>7}")
+    for result in results:
+        before = baseline.get((result["benchmark"], result["size"]))
+        if not before:
+            continue
+        ratio = result["seconds"] / before
+        flag = " REGRESSION" if ratio > threshold else ""
+        print(f"{result['benchmark']:<36} {result['size']:>9} {before * 1_000_000:>12.1f} {result['seconds'] * 1_000_000:>12.1f} {ratio:>7.2f}{flag}")
+        if flag:
+            regressions.append(result)
+    return regressions
+
+
+def run_suite(options):
+    results = bench_suite(options.sizes or [1_000, 10_000, 100_000], options.storages, options.queries, options.seed)
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "seed": options.seed,
+            "queries": options.queries,
+        },
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    if options.compare and compare(results, options.compare, options.threshold):
+        sys.exit(1)
+
+
+BENCHMARKS = {
+    "search": lambda options: bench_search(options.sizes or [10_000, 100_000, 1_000_000], options.terms),
+    "memory": lambda options: bench_memory(options.sizes or [10_000, 100_000, 1_000_000]),
+    "server": lambda options: bench_server(options.sizes or [10_000], options.clients, options.commands, options.write_ratio),
+    "suite": run_suite,
+    "parser": lambda options: bench_parser(options.queries),
+    "startup": lambda options: bench_startup(options.sizes or [1_000, 10_000, 100_000]),
+    "shards": lambda options: bench_shards(options.sizes or [100_000, 1_000_000], options.short_terms, options.workers),
+    "transactions": lambda options: bench_transactions(options.sizes or [1_000, 10_000, 100_000], ["journal", "sqlite"]),
+    "query_cache": lambda options: bench_query_cache(options.sizes or [10_000, 100_000], options.queries * 10, options.write_ratio),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bot performance benchmarks")
+    parser.add_argument("benchmark", choices=BENCHMARKS.keys())
+    parser.add_argument("--sizes", type=int, nargs="+", help="data sizes to benchmark, each benchmark has its own default")
+    parser.add_argument("--terms", nargs="+", default=["kalo", "vima", "0501", "123456"])
+    parser.add_argument("--short-terms", nargs="+", default=["ka", "7", "e"], help="terms too short for the trigram index, scanned by the shards benchmark")
+    parser.add_argument("--workers", type=int, help="most worker processes tried by the shards benchmark, the CPU count by default")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients for the server benchmark")
+    parser.add_argument("--commands", type=int, default=500, help="commands sent by each server benchmark client")
+    parser.add_argument("--write-ratio", type=float, default=0.1, help="share of server and query cache benchmark commands that write")
+    parser.add_argument("--storages", nargs="+", choices=["pickle", "journal"], default=["pickle", "journal"], help="snapshot storage backends measured by the suite")
+    parser.add_argument("--queries", type=int, default=200, help="queries per operation in the suite")
+    parser.add_argument("--seed", type=int, default=42, help="seed for the suite's synthetic data")
+    parser.add_argument("--output", metavar="FILE", help="write suite results as JSON to FILE")
+    parser.add_argument("--compare", metavar="FILE", help="compare suite results with a JSON baseline and fail on regressions")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio reported as a regression")
+    options = parser.parse_args()
+    BENCHMARKS[options.benchmark](options)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,18 @@
-import shlex
-from Contacts import AddressBook, Record, DuplicatedPhoneError
+import argparse
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date
+from functools import wraps
+from itertools import chain, islice
+from Cache import QueryCache
+from Console import Console, BatchConsole
+from Contacts import AddressBook, Record, DuplicatedPhoneError, strip_phone_symbols
+from Locks import ReadWriteLock
+from Metrics import Metrics
 from Notes import Notes, Note
-from Serialization import SerializationContext
+from Serialization import SerializationContext, Autosaver
 from Suggestions import Suggester
 
 
@@ -20,41 +31,122 @@ GREETING_RESPONSES = {
 
 records: AddressBook = None
 notes: Notes = None
+import_workers: int = None
+read_only = False
+shared_context: SerializationContext = None
+
+
+class Session:
+    def __init__(self) -> None:
+        self.greetings = 0
+
+
+SESSION: ContextVar = ContextVar("session", default=Session())
+LOCK = ReadWriteLock()
+METRICS = Metrics()
+QUERY_CACHE = QueryCache()
+
+def count_error(command: str) -> None:
+    if METRICS.enabled:
+        METRICS.error(command)
 
 def input_error(*expected_args):
     def input_error_wrapper(func):
+        command = func.__name__.removesuffix("_handler")
         def inner(*args):
             try:
                 return func(*args)
             except IndexError:
+                count_error(command)
                 return f"Please enter {' and '.join(expected_args)}"
-            except KeyError:
-                return f"The record for contact {args[0]} not found. Try another contact or use help."
+            except KeyError as error:
+                count_error(command)
+                return contact_not_found(command, args, error.args[0] if error.args else args[0])
             except ValueError as error:
+                count_error(command)
                 if error.args:
                     return error.args[0]
                 return f"Phone format '{args[1]}' is incorrect. Use digits only for phone number."
             except DuplicatedPhoneError as phone_error:
+                count_error(command)
                 return f"Phone number {phone_error.args[1]} already exists for contact {phone_error.args[0]}."
             except AttributeError:
+                count_error(command)
                 return f"Contact {args[0]} doesn't have birthday yet."
         return inner
     return input_error_wrapper
 
-def capitalize_args(*indexes):
-    def capitalize(func):
+def contact_not_found(command: str, args: tuple, name: str):
+    idx = next(filter(lambda idx: args[idx].lower().title() == name, range(len(args))), None)
+    similar = records.similar_names(name, 1) if idx is not None else None
+    if not similar:
+        return f"The record for contact {name} not found. Try another contact or use help."
+    import shlex
+    sug_command = shlex.join([command, *args[:idx], similar[0], *args[idx + 1:]])
+    return (f"The record for contact {name} not found. Did you mean '{similar[0]}'?", sug_command)
+
+def command(*expected_args, required=None, capitalize=(), types=None):
+    required = len(expected_args) if required is None else required
+    types = types or {}
+    def command_wrapper(func):
+        handler = input_error(*expected_args)(func)
+        name = func.__name__.removesuffix("_handler")
         def inner(*args):
-            new_args = list(args)
-            for idx in indexes:
-                new_args[idx] = new_args[idx].lower().title()
-            return func(*new_args)
+            if len(args) < required:
+                count_error(name)
+                return f"Please enter {' and '.join(expected_args)}"
+            if not (capitalize or types):
+                return handler(*args)
+            args = list(args)
+            for idx in capitalize:
+                if idx < len(args):
+                    args[idx] = args[idx].lower().title()
+            for idx, (cast, message) in types.items():
+                if idx < len(args):
+                    try:
+                        args[idx] = cast(args[idx])
+                    except ValueError:
+                        count_error(name)
+                        return message
+            return handler(*args)
         return inner
-    return capitalize
+    return command_wrapper
+
+def atomic(*stores):
+    def atomic_wrapper(func):
+        @wraps(func)
+        def inner(*args):
+            opened = [store() for store in stores]
+            for store in opened:
+                store.begin()
+            try:
+                result = func(*args)
+            except BaseException:
+                for store in opened:
+                    store.rollback()
+                raise
+            for store in opened:
+                store.commit()
+            return result
+        return inner
+    return atomic_wrapper
+
+def contacts_store():
+    return records
+
+def notes_store():
+    return notes
 
 def unknown_handler (*words):
-    suggester = Suggester(words[0])
+    suggester = None
     def inner(*args) -> str:        
+        nonlocal suggester
+        started = time.perf_counter()
+        # the vocabulary tables are built on the first unknown command, not at start-up
+        suggester = suggester or Suggester(words[0])
         suggestion = suggester.suggest(args[0]) or ""
+        if METRICS.enabled:
+            METRICS.stage("suggest", time.perf_counter() - started)
         if suggestion:      
             sug_command = f"{suggestion} {' '.join(*args[1:])}".strip()   
 
@@ -72,8 +164,8 @@ def help_handler():
         return help_txt
     return inner
 
-@capitalize_args(0)
-@input_error("name", "phone")
+@command("name", "phone", required=1, capitalize=(0,))
+@atomic(contacts_store)
 def add_handler(*args) -> str:
     user_name = args[0]
     user_phones = args[1:]
@@ -91,7 +183,8 @@ def add_handler(*args) -> str:
             response.append(f"New phone number {user_phone} for contact {user_name} added.")
         return "\n".join(response)
 
-@input_error("title", "text")
+@command("title", "text", required=1)
+@atomic(notes_store)
 def note_handler(*args) -> str:
     note_title = args[0]
     note_text = " ".join(args[1:])
@@ -108,8 +201,8 @@ def note_handler(*args) -> str:
         return f"{note}"
     return f"Note with title '{note_title}' already exists"
 
-@capitalize_args(0)
-@input_error("name", "old_phone", "new_phone")
+@command("name", "old_phone", "new_phone", capitalize=(0,))
+@atomic(contacts_store)
 def change_handler(*args) -> str:
     user_name = args[0]
     old_phone = args[1]
@@ -119,8 +212,8 @@ def change_handler(*args) -> str:
         record.edit_phone(old_phone, new_phone)
         return f"Phone number for {user_name} changed from {old_phone} to {new_phone}."
 
-@capitalize_args(1)
-@input_error("entity","name|title")
+@command("entity", "name|title", required=1)
+@atomic(contacts_store, notes_store)
 def delete_handler(*args) -> str:
     first_arg = 0
     if args[0].lower() == "note":
@@ -135,7 +228,7 @@ def delete_handler(*args) -> str:
     else:
         first_arg = 0
     
-    user_name = args[first_arg]
+    user_name = args[first_arg].lower().title()
     user_phones = args[first_arg+1:]
 
     if len(user_phones) >= 1:
@@ -151,8 +244,8 @@ def delete_handler(*args) -> str:
             return f"Record for contact {user_name} deleted."
         return f"Record for contact {user_name} not found."
 
-@capitalize_args(0)    
-@input_error("name")
+@command("name", capitalize=(0,))
+@atomic(contacts_store)
 def birthday_handler(*args) -> str:
     user_name = args[0]
     user_birthday = args[1] if len(args) > 1 else None
@@ -164,16 +257,13 @@ def birthday_handler(*args) -> str:
         else:
             return f"{record.days_to_birthday()} days to the next {user_name}'s birthday ({record.birthday})."
 
-@input_error([])
-def greet_handler(num: int) -> str:
-    def inner_greet(*args):
-        nonlocal num
-        num = num + 1 if num < 7 else 7
-        return GREETING_RESPONSES[num]
-    return inner_greet
+@command()
+def greet_handler(*args) -> str:
+    session = SESSION.get()
+    session.greetings = session.greetings + 1 if session.greetings < 7 else 7
+    return GREETING_RESPONSES[session.greetings]
 
-@capitalize_args(0)
-@input_error("name")
+@command("name", capitalize=(0,))
 def phone_handler(*args) -> str:
     user_name = args[0]
     record = records.find(user_name)
@@ -181,13 +271,18 @@ def phone_handler(*args) -> str:
         return "; ".join(map(lambda phone: str(phone), record.phones))    
     return f"Record for contact {user_name} not found."
 
-@input_error("entity", "term")
+@command("entity", "term", required=1)
 def search_handler(*args) -> str:
     entity = args[0]
     term = ""
     if entity == "notes":
         term = " ".join(args[1:])
-        result = notes.search_notes(term)   
+        # the same words in any order and spacing make the same query
+        key, stamp = ("notes", tuple(sorted(set(term.split())))), notes.version
+        titles = QUERY_CACHE.lookup(key, stamp)
+        if titles is None:
+            titles = QUERY_CACHE.fill(key, stamp, notes.matching_titles(term))
+        result = started_pages(notes.search_notes(term, titles))
         if result:
             return result 
         return f"No notes found for '{term}' tag."
@@ -195,12 +290,55 @@ def search_handler(*args) -> str:
         term = args[1]
     else:
         term = args[0]
-    contacts = records.search_contacts(term)
-    if contacts:
-        return "\n".join(map(lambda contact: str(contact), contacts))    
+    key, stamp = ("contacts", term), records.version
+    names = QUERY_CACHE.lookup(key, stamp)
+    if names is None:
+        contacts = QUERY_CACHE.fill(key, stamp, records.matching_contacts(term), lambda contact: contact.name.value)
+    else:
+        contacts = records.matching_contacts(term, names)
+    pages = started_pages(records.iterator(contacts=contacts))
+    if pages:
+        return pages
     return f"No contacts found for '{term}'."
 
-@input_error([])
+@command("phone|prefix|duplicates")
+def who_handler(*args) -> str:
+    if args[0].lower() == "duplicates":
+        lines = (f"{phone}: {', '.join(record.name.value for record in owners)}" for phone, owners in records.duplicate_phones())
+        pages = started_pages(iter(lambda: list(islice(lines, records.page_size)), []))
+        return pages or "No phone number belongs to more than one contact."
+    prefix = strip_phone_symbols(args[0])
+    if not prefix.isdigit() or len(prefix) > 10:
+        return f"Phone number or prefix '{args[0]}' is incorrect. Use up to 10 digits."
+    lines = (f"{phone}: {record.name.value}" for phone, record in records.phones_by_prefix(prefix))
+    pages = started_pages(iter(lambda: list(islice(lines, records.page_size)), []))
+    return pages or f"No contacts found with phone number starting with {prefix}."
+
+@command("tag|count", required=0)
+def tags_handler(*args) -> str:
+    stats = notes.tag_stats()
+    if not args or args[0].isdigit():
+        top = stats.top(int(args[0]) if args else 10)
+        if not top:
+            return "No tags found in notes."
+        return "\n".join(tag_line(stats, tag) for tag in top)
+    tag = args[0].removeprefix("#").lower()
+    if not stats.frequency(tag)[0]:
+        return f"No notes tagged '#{tag}'."
+    related = ", ".join(f"#{other} ({count})" for other, count in stats.related(tag))
+    recent = ", ".join(f"'{title}'" for title in stats.recent(tag))
+    return f"{tag_line(stats, tag)}\nOften together with: {related or 'no other tags'}\nRecent notes: {recent}"
+
+def tag_line(stats, tag: str) -> str:
+    tagged, uses = stats.frequency(tag)
+    return f"#{tag}: {plural(tagged, 'note')}, {plural(uses, 'use')}"
+
+def started_pages(pages):
+    # a generator is always truthy, so peek at the first page to tell an empty result apart
+    page = next(pages, None)
+    return chain([page], pages) if page else None
+
+@command("entity", "days", required=0, types={1: (int, "Please enter days as a number.")})
 def show_handler(*args) -> str:
     if not args:
         return records.iterator() 
@@ -209,71 +347,340 @@ def show_handler(*args) -> str:
     if args[0] == "notes":
         return notes.iterator()
     if args[0] == "birthdays":
-        days = args[1]
-        return records.get_contacts_by_birthdays(int(days))
+        days = args[1] if len(args) > 1 else None
+        # upcoming birthdays move with the date as well as with the contacts
+        today = date.today()
+        key, stamp = ("birthdays", days, today), records.version
+        names = QUERY_CACHE.lookup(key, stamp)
+        if names is None:
+            upcoming = (record for _, record in records.upcoming_birthdays(days, today))
+            return records.iterator(contacts=QUERY_CACHE.fill(key, stamp, upcoming, lambda record: record.name.value))
+        return records.get_contacts_by_birthdays(days, names)
     return records.iterator() 
 
+@command("file")
+def import_handler(*args) -> str:
+    path = args[0]
+    reject_path = args[1] if len(args) > 1 else None
+    try:
+        report = records.import_file(path, reject_path, import_workers)
+    except OSError as error:
+        return f"Cannot import '{path}': {error.strerror}."
+    response = f"Imported from '{path}': {report['added']} added, {report['updated']} updated, {report['rejected']} rejected, {report['duplicates']} duplicate phones skipped."
+    if reject_path and (report['rejected'] or report['duplicates']):
+        response += f" See '{reject_path}' for details."
+    return response
+
+@command("file")
+def export_handler(*args) -> str:
+    path = args[0]
+    try:
+        count = records.export_file(path)
+    except OSError as error:
+        return f"Cannot export to '{path}': {error.strerror}."
+    return f"Exported {count} contacts to '{path}'."
+
+def plural(count: int, noun: str) -> str:
+    return f"{count} {noun}{'s' if count != 1 else ''}"
+
+@command()
+def begin_handler(*args) -> str:
+    nested = records.in_transaction
+    records.begin()
+    notes.begin()
+    if nested:
+        return "Nested transaction started. Its commit keeps the changes for the enclosing transaction."
+    return "Transaction started. Changes are kept until 'commit' and dropped by 'rollback'."
+
+@command()
+def commit_handler(*args) -> str:
+    if not records.in_transaction:
+        return "No transaction to commit. Use 'begin' first."
+    if records.has_conflict() or notes.has_conflict():
+        # both stores commit or neither does, and enclosing levels could not commit either
+        discarded = rollback_all()
+        return f"Contacts or notes were changed by another session since 'begin'. Transaction rolled back, {plural(discarded, 'change')} discarded."
+    try:
+        changes = records.commit() + notes.commit()
+    except DuplicatedPhoneError as error:
+        # a refused commit has already dropped the contacts, so the notes cannot commit alone
+        notes.rollback()
+        return f"Phone number {error.args[1]} already exists for contact {error.args[0]}. Transaction rolled back."
+    if records.in_transaction:
+        return f"{plural(changes, 'change')} kept for the enclosing transaction."
+    return f"Transaction committed with {plural(changes, 'change')}."
+
+@command()
+def rollback_handler(*args) -> str:
+    if not records.in_transaction:
+        return "No transaction to roll back."
+    discarded = records.rollback() + notes.rollback()
+    return f"Transaction rolled back, {plural(discarded, 'change')} discarded."
+
+def rollback_all() -> int:
+    discarded = 0
+    while records.in_transaction:
+        discarded += records.rollback() + notes.rollback()
+    return discarded
+
+def discard_transactions(console: Console) -> None:
+    # a session ending inside a transaction drops it, as a database does on disconnect
+    if not records.in_transaction:
+        return
+    discarded = rollback_all()
+    console.write(f"Uncommitted transaction rolled back, {plural(discarded, 'change')} discarded.")
+
+@command()
+def stats_handler(*args) -> str:
+    if args and args[0] == "cache":
+        if not QUERY_CACHE.enabled:
+            return "Query cache is disabled. Start the bot with --query-cache N to cache N results."
+        if len(args) > 1 and args[1] == "reset":
+            QUERY_CACHE.clear()
+            return "Query cache cleared."
+        return QUERY_CACHE.report()
+    if not METRICS.enabled:
+        return "Metrics are disabled. Start the bot with --metrics to collect them."
+    if args and args[0] == "json":
+        return METRICS.to_json()
+    if args and args[0] == "reset":
+        METRICS.reset()
+        return "Metrics reset."
+    return METRICS.report()
+
 COMMANDS = {
     "add": add_handler,
     "change": change_handler,
     "phone": phone_handler,
     "show": show_handler,
-    "greet": greet_handler(0),
+    "greet": greet_handler,
     "delete": delete_handler,
     "birthday": birthday_handler,
     "search": search_handler,
     "note": note_handler,
     "help": help_handler(),    
+    "import": import_handler,
+    "export": export_handler,
+    "stats": stats_handler,
+    "who": who_handler,
+    "tags": tags_handler,
+    "begin": begin_handler,
+    "commit": commit_handler,
+    "rollback": rollback_handler,
 }
 
+COMMAND_NAMES = {handler: name for name, handler in COMMANDS.items()}
+
+WRITE_HANDLERS = {add_handler, change_handler, delete_handler, birthday_handler, note_handler, import_handler,
+                  begin_handler, commit_handler, rollback_handler}
+
+# write handlers that only look data up when given no more than this many arguments
+LOOKUP_ARITY = {note_handler: 1}
+
 UNKNOWN_COMMAND = unknown_handler(set(COMMANDS.keys()).union(GREET_COMMANDS, EXIT_COMMANDS))
 
+def read_only_handler(*args) -> str:
+    return f"Command '{args[0]}' changes data and is not available on a read-only snapshot."
+
+def tokenize(input: str) -> list:
+    # shlex is only needed for quoting and escapes; plain lines split the same way on whitespace
+    if '"' in input or "'" in input or "\\" in input:
+        import shlex
+        return shlex.split(input)
+    return input.split()
+
 def command_parser(input:str) -> tuple:
-    clauses = []
-    command = ""
-    args = []
     if input.lower() in GREET_COMMANDS:
-        command = "greet" 
-    else:
-        clauses = shlex.split(input)
-        if clauses:
-            command = clauses[0]              
-            if len(clauses) > 0:
-                args = clauses[1:]
-    if command.lower() in COMMANDS.keys():
-        return COMMANDS[command.lower()], args
-    
-    return UNKNOWN_COMMAND, (command.lower(), args)
+        return COMMANDS["greet"], []
+    clauses = tokenize(input)
+    if not clauses:
+        return UNKNOWN_COMMAND, ("", [])
+    command = clauses[0].lower()
+    handler = COMMANDS.get(command)
+    if read_only and handler in WRITE_HANDLERS and len(clauses) - 1 > LOOKUP_ARITY.get(handler, -1):
+        return read_only_handler, [command]
+    if handler:
+        return handler, clauses[1:]
+    return UNKNOWN_COMMAND, (command, clauses[1:])
 
-def process_input(user_input: str):
+CONSOLE = Console()
+
+def process_input(user_input: str, console: Console = CONSOLE):
     user_input = user_input.strip()
     if user_input in EXIT_COMMANDS:
         return "<break>"    
-    func, data = command_parser(user_input)
-    result = func(*data)
+    if METRICS.enabled:
+        func, result = run_measured(user_input)
+    else:
+        func, data = command_parser(user_input)
+        with command_lock(func):
+            result = func(*data)
     if isinstance(result, str):
-        print(result)
+        console.write(result)
     elif isinstance(result, tuple):
-        print(result[0])
-        print("Type 'yes' or 'y' to run the suggested command or press enter to skip.")
-        answer = input(">>> ")
-        if answer.lower() in ('yes', 'y'):                    
-            return process_input(result[1])
+        console.write(result[0])
+        if console.confirm("Type 'yes' or 'y' to run the suggested command or press enter to skip."):
+            return process_input(result[1], console)
+    elif result is not None:
+        pages = iter(result)
+        while True:
+            # pages resume from a position cursor, so writes from other sessions between pages are safe
+            with command_lock(func):
+                page = next(pages, None)
+            if page is None:
+                break
+            console.write("\n".join(page))
+            console.pause("Press enter to show more records")     
+
+def command_lock(func):
+    if shared_context:
+        return shared_command_lock(func)
+    return LOCK.write() if func in WRITE_HANDLERS else LOCK.read()
+
+@contextmanager
+def shared_command_lock(func):
+    # other bot processes change the same files: writers catch up under the file locks,
+    # readers replay only when the storage reports something new
+    if func in WRITE_HANDLERS:
+        with LOCK.write(), shared_context.locked():
+            yield
+        return
+    if shared_context.has_changes():
+        with LOCK.write():
+            shared_context.refresh()
+    with LOCK.read():
+        yield
+
+def run_measured(user_input: str) -> tuple:
+    started = time.perf_counter()
+    func, data = command_parser(user_input)
+    parsed = time.perf_counter()
+    METRICS.stage("parse", parsed - started)
+    failed = True
+    try:
+        with command_lock(func):
+            METRICS.stage("lock wait", time.perf_counter() - parsed)
+            result = func(*data)
+        failed = False
+    finally:
+        METRICS.command(COMMAND_NAMES.get(func, "unknown"), time.perf_counter() - parsed, failed)
+    return func, result
+
+def run_session(console: Console = CONSOLE):
+    SESSION.set(Session())
+    while True:
+        try:
+            user_input = console.read()
+        except EOFError:
+            break
+        if process_input(user_input, console) == "<break>":
+            discard_transactions(console)
+            console.write("Good bye!")
+            return
+    discard_transactions(console)
+
+def run_batch(stream, context: SerializationContext, flush_every: int = None):
+    console = BatchConsole()
+    commands = 0
+    try:
+        for line in stream:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if process_input(line, console) == "<break>":
+                break
+            commands += 1
+            if flush_every and commands % flush_every == 0:
+                context.flush()
+        discard_transactions(console)
+    finally:
+        console.flush()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Contacts and notes assistant bot")
+    parser.add_argument("--batch", metavar="FILE", help="run commands from FILE ('-' for stdin) without prompts or paging")
+    parser.add_argument("--flush-every", type=int, metavar="K", help="flush storage every K batch commands")
+    parser.add_argument("--storage", choices=["pickle", "journal", "sqlite", "snapshot"], default="journal", help="storage backend for contacts and notes")
+    parser.add_argument("--migrate", action="store_true", help="rewrite stored data in the current compact layout and exit")
+    parser.add_argument("--write-snapshot", action="store_true", help="write a read-only snapshot of stored data for --storage snapshot and exit")
+    parser.add_argument("--shared", action="store_true", help="share the storage with other bot processes, locking writes and following their changes")
+    parser.add_argument("--serve", metavar="ADDRESS", help="serve many clients over HOST:PORT or a unix socket path")
+    parser.add_argument("--max-sessions", type=int, default=64, help="concurrent sessions served before new clients wait")
+    parser.add_argument("--import-workers", type=int, metavar="N", help="validate imported rows in N worker processes")
+    parser.add_argument("--shards", type=int, default=1, metavar="N", help="partition contacts across N shards, scanning them in parallel on big books")
+    parser.add_argument("--shard-workers", type=int, metavar="N", help="worker processes for sharded scans, one per shard by default")
+    parser.add_argument("--unique-phones", action="store_true", help="refuse a phone number that already belongs to another contact")
+    parser.add_argument("--lazy-start", action="store_true", help="show the prompt at once and load contacts and notes in the background")
+    parser.add_argument("--autosave", type=float, default=30.0, metavar="SECONDS", help="save changed data in the background every SECONDS, 0 turns it off; the pickle storage saves on exit only")
+    parser.add_argument("--autosave-ops", type=int, metavar="N", help="also save in the background after every N changes")
+    parser.add_argument("--page-size", type=int, default=2, help="contacts or notes shown per page")
+    parser.add_argument("--query-cache", type=int, default=256, metavar="N", help="keep the results of the last N search and show birthdays queries, 0 turns it off")
+    parser.add_argument("--metrics", nargs="?", const="", metavar="FILE", help="collect command and storage metrics, dumping them as JSON to FILE on exit")
+    options = parser.parse_args(argv)
+    if options.shared and options.storage == "pickle":
+        parser.error("--shared needs the journal, sqlite or snapshot storage")
+    METRICS.enabled = options.metrics is not None
+    QUERY_CACHE.size = max(options.query_cache, 0)
+    try:
+        run(options)
+    finally:
+        if options.metrics:
+            METRICS.dump(options.metrics)
+
+def run(options: argparse.Namespace):
+    global records, notes, import_workers, read_only, shared_context
+    import_workers = options.import_workers
+    if options.shards > 1:
+        from Shards import ShardedAddressBook
+        book = ShardedAddressBook("address_book.pkl", options.shards, options.shard_workers)
     else:
-        for i in result:                
-            print ("\n".join(i))
-            input("Press enter to show more records")     
-
-def main():
-    global records, notes
-    with SerializationContext(AddressBook("address_book.pkl"), Notes("notes.pkl")) as context:
-        records = context[AddressBook]        
+        book = AddressBook("address_book.pkl")
+    notebook = Notes("notes.pkl")
+    # settings go on the stores before loading, which with --lazy-start runs in the background
+    book.page_size = notebook.page_size = options.page_size
+    book.unique_phones = options.unique_phones
+    read_only = getattr(book.storage_class(options.storage), "read_only", False)
+    with SerializationContext(book, notebook, storage=options.storage, metrics=METRICS, shared=options.shared, lazy=options.lazy_start) as context:
+        records = context[type(book)]        
         notes = context[Notes]        
-        while True:
-            user_input = input(">>> ")            
-            if process_input(user_input) == "<break>":
-                print("Good bye!")
-                break      
+        shared_context = context if options.shared else None
+        if options.migrate:
+            context.compact()
+            return
+        if options.write_snapshot:
+            from Snapshot import write_snapshot
+            context.wait()
+            for obj in (book, notebook):
+                write_snapshot(obj)
+            return
+        if options.unique_phones and not options.lazy_start:
+            report_duplicate_phones(CONSOLE)
+        autosaver = None
+        # background saves only flush what journal and sqlite storages already wrote
+        if (options.autosave or options.autosave_ops) and book.storage_class(options.storage).incremental:
+            autosaver = Autosaver(context, options.autosave or None, options.autosave_ops, LOCK.read).start()
+        try:
+            run_commands(options, context)
+        finally:
+            if autosaver:
+                autosaver.stop()
+
+def report_duplicate_phones(console: Console) -> None:
+    duplicates = sum(1 for _ in records.duplicate_phones())
+    if duplicates:
+        console.write(f"Contacts already share {plural(duplicates, 'phone number')}; --unique-phones refuses only new duplicates. See 'who duplicates'.")
+
+def run_commands(options: argparse.Namespace, context: SerializationContext):
+    if options.batch:
+        stream = sys.stdin if options.batch == "-" else open(options.batch, encoding="utf-8")
+        with stream:
+            run_batch(stream, context, options.flush_every)
+        return
+    if options.serve:
+        from Server import serve
+        serve(options.serve, run_session, options.max_sessions)
+        return
+    run_session(CONSOLE)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+import threading
+from collections import Counter, OrderedDict
+
+
+class QueryCache:
+    # results are stamped with the version of the store they were read from; a store that
+    # changed since no longer matches its stamp, so writes never have to evict anything
+    def __init__(self, size=256, max_result=10000) -> None:
+        self.size = size
+        self.max_result = max_result
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = Counter()
+        self.__misses = Counter()
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def lookup(self, key: tuple, stamp):
+        # the cached names, or None when the query has to run
+        if not self.enabled:
+            return None
+        kind = key[0]
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self.__entries.move_to_end(key)
+                self.__hits[kind] += 1
+                return entry[1]
+            self.__misses[kind] += 1
+        return None
+
+    def fill(self, key: tuple, stamp, results, name=None):
+        # results still stream to the caller; a disabled cache does not even watch them go by
+        if not self.enabled:
+            return results
+        return self.__filling(key, stamp, results, name)
+
+    def __filling(self, key: tuple, stamp, results, name):
+        # names are kept as results are read and only cached once they run out; a result
+        # read in part or longer than max_result is not worth the memory
+        names = []
+        for value in results:
+            if names is not None:
+                names.append(name(value) if name else value)
+                if len(names) > self.max_result:
+                    names = None
+            yield value
+        if names is None:
+            return
+        # the stamp was read before the query ran, so a result racing a change is only stored as stale
+        with self.__lock:
+            self.__entries[key] = (stamp, names)
+            self.__entries.move_to_end(key)
+            if len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+            self.__hits.clear()
+            self.__misses.clear()
+
+    def stats(self) -> dict:
+        with self.__lock:
+            kinds = sorted(set(self.__hits) | set(self.__misses))
+            queries = {kind: {"hits": self.__hits[kind], "misses": self.__misses[kind]} for kind in kinds}
+            entries = len(self.__entries)
+        hits = sum(counts["hits"] for counts in queries.values())
+        misses = sum(counts["misses"] for counts in queries.values())
+        return {"size": self.size, "entries": entries, "hits": hits, "misses": misses, "queries": queries}
+
+    def report(self) -> str:
+        stats = self.stats()
+        lines = [f"Query cache: {stats['entries']} of {stats['size']} entries, {rate_line(stats['hits'], stats['misses'])}"]
+        for kind, counts in stats["queries"].items():
+            lines.append(f"  {kind}: {rate_line(counts['hits'], counts['misses'])}")
+        return "\n".join(lines)
+
+
+def rate_line(hits: int, misses: int) -> str:
+    total = hits + misses
+    rate = hits / total * 100 if total else 0.0
+    return f"{hits} hits, {misses} misses, {rate:.1f}% hit rate"
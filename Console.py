@@ -0,0 +1,46 @@
+import sys
+
+
+class Console:
+    def write(self, text: str) -> None:
+        print(text)
+
+    def read(self, prompt: str = ">>> ") -> str:
+        return input(prompt)
+
+    def confirm(self, message: str) -> bool:
+        self.write(message)
+        return self.read().lower() in ('yes', 'y')
+
+    def pause(self, message: str) -> None:
+        self.read(message)
+
+    def flush(self) -> None:
+        ...
+
+
+class BatchConsole(Console):
+    def __init__(self, stream=None, buffer_size=1000) -> None:
+        self.__stream = stream or sys.stdout
+        self.__buffer_size = buffer_size
+        self.__lines = []
+
+    def write(self, text: str) -> None:
+        self.__lines.append(text)
+        if len(self.__lines) >= self.__buffer_size:
+            self.flush()
+
+    def read(self, prompt: str = ">>> ") -> str:
+        return ""
+
+    def confirm(self, message: str) -> bool:
+        return False
+
+    def pause(self, message: str) -> None:
+        ...
+
+    def flush(self) -> None:
+        if self.__lines:
+            self.__stream.write("\n".join(self.__lines) + "\n")
+            self.__lines.clear()
+        self.__stream.flush()
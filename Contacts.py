@@ -1,28 +1,79 @@
 import pickle
+import re
 import traceback
 from pathlib import Path
 from datetime import date,timedelta
-from functools import reduce
-from collections import UserDict
+from itertools import groupby, islice
+from collections import UserDict, defaultdict
 from Serialization import Serializable
+from Indexes import NgramIndex, BirthdayIndex, OrderIndex, PhoneIndex, NameIndex, next_birthday
+
+PHONE_SYMBOLS = "+()-"
+DATE_PATTERN = re.compile(r"(\d+)([./-])(\d+)\2(\d+)", re.ASCII)
+DAYS_IN_MONTH = (0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+COLUMN_CHUNK_SIZE = 100_000
+
+
+def strip_phone_symbols(value: str) -> str:
+    # chained str.replace beats str.translate with a deletion table several times over
+    for symbol in PHONE_SYMBOLS:
+        value = value.replace(symbol, "")
+    return value
+
+
+def map_columns(func, values: list, workers: int = None, chunk_size=COLUMN_CHUNK_SIZE) -> list:
+    # a process pool only pays for its start-up and pickling on columns spanning several chunks
+    if not workers or workers == 1 or len(values) <= chunk_size:
+        return func(values)
+    chunks = [values[idx:idx + chunk_size] for idx in range(0, len(values), chunk_size)]
+    with process_pool(workers) as pool:
+        return [item for result in pool.map(func, chunks) for item in result]
+
+
+def process_pool(workers: int):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    # spawned rather than forked, since the bot may be running autosave and session threads
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+
 
 class DuplicatedPhoneError(Exception):
     ...
 
 
 class Field():
+    __slots__ = ("__value",)
+
     def __init__(self, value: str):
         self.__value = value
 
+    @classmethod
+    def _from_raw(cls, raw) -> "Field":
+        field = cls.__new__(cls)
+        field.__value = raw
+        return field
+
     @property
     def value(self) -> str:
         return self.__value
    
+    def _get_value(self):
+        return self.__value
+
     def _set_value(self, value) -> None:
         self.__value = value
 
+    def __getstate__(self) -> tuple:
+        return (self.__value,)
+
+    def __setstate__(self, state) -> None:
+        if isinstance(state, dict):
+            # instances pickled before __slots__ kept their value in __dict__
+            state = (state["_Field__value"],)
+        self.__value, = state
+
     def __str__(self) -> str:
-        return str(self.__value)
+        return str(self.value)
     
     def __repr__(self) -> str:
         return self.__str__()
@@ -32,47 +83,88 @@ class Field():
 
 
 class Name(Field):
-    ...
+    __slots__ = ()
 
 
 class Phone(Field):
+    __slots__ = ()
+
     def __init__(self, value: str) -> None:
         self.value = value
     
     @property
     def value(self) -> str:
-        return super().value
+        raw = super().value
+        return raw if isinstance(raw, str) else f"{raw:010d}"
 
     @value.setter
     def value(self, value: str) -> None:
-        super()._set_value(self.__validate(value))
+        super()._set_value(self.__pack(self.__validate(value)))
+
+    @staticmethod
+    def __pack(value: str):
+        # ten ASCII digits fit a small int; anything else isdigit() accepts stays a str
+        return int(value) if value.isascii() else value
+
+    def __setstate__(self, state) -> None:
+        super().__setstate__(state)
+        raw = self._get_value()
+        if isinstance(raw, str):
+            self._set_value(self.__pack(raw))
 
     def __validate(self, value: str) -> str:
-        value = reduce((lambda a, b: a.replace(b, "")), "+()-", value)        
+        value = strip_phone_symbols(value)
         if value.isdigit() and len(value) == 10:
             return value
         else:
             raise ValueError(f"Phone number'{value}' is incorrect. Phone number should consist of 10 digits.")
+
+    @classmethod
+    def normalize_many(cls, values, workers: int = None) -> list:
+        return map_columns(cls.normalize_column, list(values), workers)
+
+    @staticmethod
+    def normalize_column(values: list) -> list:
+        # strip the symbols from the whole column in one pass; a value holding a newline
+        # would split into extra pieces, so such columns fall back to per-value stripping
+        normalized = strip_phone_symbols("\n".join(values)).split("\n") if values else []
+        if len(normalized) != len(values):
+            normalized = [strip_phone_symbols(value) for value in values]
+        return [value if len(value) == 10 and value.isdigit() else None for value in normalized]
+
+    @classmethod
+    def trusted(cls, value: str) -> "Phone":
+        return cls._from_raw(cls.__pack(value))
         
 
 class Birthday(Field):
+    __slots__ = ()
+
     def __init__(self, value: str) -> None:
         self.value = value
 
     @property
     def value(self) -> str:
-        return super().value
+        birthday = self.date
+        return f"{birthday.day}-{birthday.month}-{birthday.year}"
 
     @property
     def date(self) -> date:
-        return date(self.__year, self.__month, self.__day)
+        return date.fromordinal(super().value)
         
     @value.setter
     def value(self, value: str) -> None:
-        self.__year, self.__month, self.__day = self.__validate(value)
-        super()._set_value(f"{self.__day}-{self.__month}-{self.__year}")
+        year, month, day = self.__validate(value)
+        super()._set_value(date(year, month, day).toordinal())
+
+    def __setstate__(self, state) -> None:
+        if isinstance(state, dict):
+            # instances pickled before __slots__ kept the date as three ints
+            state = (date(state["_Birthday__year"], state["_Birthday__month"], state["_Birthday__day"]).toordinal(),)
+        super().__setstate__(state)
 
-    def __validate(self, value: str) -> tuple:
+    @staticmethod
+    def __validate(value: str) -> tuple:
         separator = "." if "." in value else "/" if "/" in value else "-"
         date_parts = value.split(separator)
         if len(date_parts) == 3:
@@ -82,11 +174,73 @@ class Birthday(Field):
                     return int(year), int(month), int(day)
         raise ValueError(f"Birthday '{value}' format is incorrect. Use DD-MM-YYYY format")
 
+    @classmethod
+    def parse_many(cls, values, workers: int = None) -> list:
+        return map_columns(cls.parse_column, list(values), workers)
+
+    @classmethod
+    def parse_column(cls, values: list) -> list:
+        # birthday columns repeat a lot, so each distinct value is parsed once
+        parsed = dict.fromkeys(values)
+        for value in parsed:
+            parsed[value] = cls.__parse(value)
+        return [parsed[value] for value in values]
+
+    @classmethod
+    def __parse(cls, value: str) -> tuple:
+        # ASCII dates are range-checked against a month table without building a date;
+        # anything else (unicode digits, odd separators) goes through the per-field rules
+        found = DATE_PATTERN.fullmatch(value)
+        if found:
+            day, _, month, year = found.groups()
+            year, month, day = int(year), int(month), int(day)
+            leap_day = month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+            if 1 <= year <= 9999 and 1 <= month <= 12 and 1 <= day <= DAYS_IN_MONTH[month] + leap_day:
+                return year, month, day
+            return None
+        try:
+            return cls.__validate(value)
+        except (ValueError, OverflowError):
+            return None
+
+    @classmethod
+    def trusted(cls, year: int, month: int, day: int) -> "Birthday":
+        return cls._from_raw(date(year, month, day).toordinal())
+
 class Record:
+    __slots__ = ("name", "phones", "birthday", "__listeners")
+
     def __init__(self, name: str, phone=None, birthday=None) -> None:
         self.name = Name(name)
         self.phones = [Phone(phone)] if phone else []
         self.birthday = Birthday(birthday) if birthday else "Not set"
+        self.__listeners = []
+
+    def __getstate__(self) -> tuple:
+        birthday = self.birthday._get_value() if isinstance(self.birthday, Birthday) else None
+        return (self.name.value, tuple(phone._get_value() for phone in self.phones), birthday)
+
+    def __setstate__(self, state) -> None:
+        if isinstance(state, dict):
+            # records pickled before __slots__ hold Field objects in __dict__
+            self.name, self.phones, self.birthday = state["name"], state["phones"], state["birthday"]
+        else:
+            name, phones, birthday = state
+            self.name = Name(name)
+            self.phones = [Phone._from_raw(phone) for phone in phones]
+            self.birthday = Birthday._from_raw(birthday) if birthday is not None else "Not set"
+        self.__listeners = []
+
+    def subscribe(self, listener) -> None:
+        self.__listeners.append(listener)
+
+    def unsubscribe(self, listener) -> None:
+        if listener in self.__listeners:
+            self.__listeners.remove(listener)
+
+    def _notify(self, event: str, *args) -> None:
+        for listener in self.__listeners:
+            listener(self, event, *args)
 
     def __str__(self) -> str:
         return f"Contact name: {self.name.value}, phones: {'; '.join(p.value for p in self.phones)}, birthday: {self.birthday}"
@@ -94,27 +248,33 @@ class Record:
     def add_phone(self, phone: str) -> None: 
         existing_phone = self.find_phone(phone)
         if not existing_phone:
-            self.phones.append(Phone(phone))
+            new_phone = Phone(phone)
+            # listeners may veto a number before the record changes
+            self._notify("claim_phone", new_phone)
+            self.phones.append(new_phone)
+            self._notify("add_phone", phone)
         else:
             raise DuplicatedPhoneError(self.name, phone)
 
     def add_birthday(self, birthday: str) -> None:
         self.birthday = Birthday(birthday)
+        self._notify("add_birthday", birthday)
 
     def days_to_birthday(self) -> int:
         if not isinstance(self.birthday, Birthday):
             return None
-        next_birthday = self.birthday.date.replace(year=date.today().year)
-        if next_birthday < date.today():
-            next_birthday = next_birthday.replace(year=next_birthday.year+1)
-        delta = next_birthday - date.today()
-        return delta.days
+        today = date.today()
+        birthday = self.birthday.date
+        return (next_birthday(birthday.month, birthday.day, today) - today).days
 
     def edit_phone(self, old_phone: str, new_phone: str) -> None:
         existing_phone = self.find_phone(old_phone)
         if existing_phone:
             idx = self.phones.index(existing_phone)
-            self.phones[idx] = Phone(new_phone)
+            phone = Phone(new_phone)
+            self._notify("claim_phone", phone)
+            self.phones[idx] = phone
+            self._notify("edit_phone", old_phone, new_phone)
         else:
             raise ValueError(f"Phone number {old_phone} not found for contact {self.name}.")
                 
@@ -122,13 +282,12 @@ class Record:
         existing_phone = self.find_phone(phone)
         if existing_phone:
             self.phones.remove(existing_phone)
+            self._notify("remove_phone", phone)
         else:
             raise ValueError(f"Phone number {phone} not found for contact {self.name}.")
                             
     def find_phone(self, phone: str) -> Phone:
-        existing_phone = list(filter(lambda p: p.value == phone, self.phones))
-        if len(existing_phone) > 0:
-            return existing_phone[0]
+        return next(filter(lambda p: p.value == phone, self.phones), None)
     
     def has_matching_phone (self, term:str) -> bool:
         phones = filter(lambda p: p.is_matching(term), self.phones)
@@ -139,35 +298,356 @@ class Record:
         
 
 class AddressBook(UserDict, Serializable):
+    RECORD_EVENTS = {"add_phone", "edit_phone", "remove_phone", "add_birthday"}
+
     def __init__(self, file_name) -> None:        
+        self.__ngrams = NgramIndex()
+        self.__birthdays = BirthdayIndex()
+        self.__order = OrderIndex()
+        self.__phones = PhoneIndex()
+        self.__names = NameIndex()
+        self.__indexed = True
+        self.page_size = 2
+        self.unique_phones = False
         UserDict.__init__(self)
         Serializable.__init__(self, file_name)
 
+    @classmethod
+    def storage_class(cls, kind: str) -> type:
+        if kind == "sqlite":
+            from SqlStorage import AddressBookSqlStorage
+            return AddressBookSqlStorage
+        if kind == "snapshot":
+            from Snapshot import AddressBookSnapshotStorage
+            return AddressBookSnapshotStorage
+        return super().storage_class(kind)
+
+    def _set_state(self, data) -> None:
+        super()._set_state(data)
+        # the search indexes cost more to build than the load itself, so they wait for the
+        # first query that needs them; until then changes only reach the indexes already built
+        self.__ngrams = None
+        self.__birthdays = BirthdayIndex()
+        self.__order = OrderIndex()
+        self.__phones = None
+        self.__names = None
+        self.__indexed = not getattr(data, "lazy", False)
+        if self.__indexed:
+            for record in self.data.values():
+                self._attach(record)
+                self.__index(record, birthday=False)
+            self.__birthdays = BirthdayIndex.bulk(
+                (name, record.birthday.date.month, record.birthday.date.day)
+                for name, record in self.data.items() if isinstance(record.birthday, Birthday))
+
+    def _attach(self, record: Record) -> None:
+        record.subscribe(self._on_record_change)
+
+    def __index(self, record: Record, birthday=True) -> None:
+        name = record.name.value
+        if self.__names is not None:
+            self.__names.add(name)
+        if not self.__indexed:
+            return
+        self.__order.add(name)
+        if self.__ngrams is not None:
+            self.__ngrams.update(name, name.lower(), *(phone.value for phone in record.phones))
+        if birthday:
+            self.__index_birthday(record)
+
+    def __index_phones(self, record: Record, phones=None, index=True) -> None:
+        if not self.__indexed or self.__phones is None:
+            return
+        update = self.__phones.add if index else self.__phones.remove
+        for phone in phones if phones is not None else record.phones:
+            update(phone._get_value(), record.name.value)
+
+    def __index_birthday(self, record: Record) -> None:
+        if not self.__indexed:
+            return
+        if isinstance(record.birthday, Birthday):
+            birthday = record.birthday.date
+            self.__birthdays.add(record.name.value, birthday.month, birthday.day)
+        else:
+            self.__birthdays.remove(record.name.value)
+
+    def __unindex(self, name: str) -> None:
+        if self.__names is not None:
+            self.__names.remove(name)
+        if not self.__indexed:
+            return
+        self.__order.remove(name)
+        if self.__ngrams is not None:
+            self.__ngrams.remove(name)
+        self.__birthdays.remove(name)
+
+    def __ngram_index(self) -> NgramIndex:
+        if self.__ngrams is None:
+            ngrams = NgramIndex()
+            for name, record in self.data.items():
+                ngrams.add(name, name.lower(), *(phone.value for phone in record.phones))
+            self.__ngrams = ngrams
+        return self.__ngrams
+
+    def __phone_index(self) -> PhoneIndex:
+        if self.__phones is None:
+            phones = PhoneIndex()
+            for name, record in self.data.items():
+                for phone in record.phones:
+                    phones.add(phone._get_value(), name)
+            self.__phones = phones
+        return self.__phones
+
+    def __name_index(self) -> NameIndex:
+        if self.__names is None:
+            names = NameIndex()
+            for name in self.data:
+                names.add(name)
+            self.__names = names
+        return self.__names
+
+    def _replay(self, op, args) -> None:
+        if op in self.RECORD_EVENTS:
+            name, *args = args
+            getattr(self.data[name], op)(*args)
+        else:
+            super()._replay(op, args)
+
+    def _on_record_change(self, record: Record, event: str, *args) -> None:
+        if event == "claim_phone":
+            self.__claim_phones(record, args)
+            return
+        if event == "add_birthday":
+            self.__index_birthday(record)
+        else:
+            self.__index(record)
+            if event in ("edit_phone", "remove_phone"):
+                self.__index_phones(record, [Phone(args[0])], index=False)
+            if event in ("add_phone", "edit_phone"):
+                self.__index_phones(record, [Phone(args[-1])])
+        self._journal(event, record.name.value, *args)
+
+    def _on_staged_change(self, record: Record, event: str, *args) -> None:
+        if event == "claim_phone":
+            self.__claim_phones(record, args)
+        else:
+            self._stage_op(event, record.name.value, *args)
+
+    def _copy(self, record: Record) -> Record:
+        copy = Record.__new__(Record)
+        copy.__setstate__(record.__getstate__())
+        copy.subscribe(self._on_staged_change)
+        return copy
+
+    def _apply(self, staged: dict) -> None:
+        for name, (record, detached, _) in staged.items():
+            if detached or record is None:
+                self.__remove(name)
+            if record is not None:
+                record.unsubscribe(self._on_staged_change)
+                self.__put(record)
+
+    def _validate(self, staged: dict) -> None:
+        # claims were checked as they were made; the numbers contacts gained over their stored
+        # versions are checked once more against the book the commit is about to store
+        if not self.unique_phones:
+            return
+        holders = defaultdict(list)
+        for name, (record, _, _) in staged.items():
+            for phone in record.phones if record is not None else ():
+                holders[phone.value].append(name)
+        for name, (record, _, _) in staged.items():
+            stored = self.data.get(name)
+            for phone in record.phones if record is not None else ():
+                if stored and stored.find_phone(phone.value):
+                    continue
+                owners = [owner for owner in self.phone_owners(phone.value) if owner not in staged] + holders[phone.value]
+                owner = next(filter(lambda owner: owner != name, owners), None)
+                if owner:
+                    raise DuplicatedPhoneError(owner, phone.value)
+
+    def __claim_phones(self, record: Record, phones) -> None:
+        # loaded and replayed changes were accepted when made; only new ones are checked
+        if not self.unique_phones or self._replaying:
+            return
+        for phone in phones:
+            owner = self.phone_owner(phone.value, record.name.value)
+            if owner:
+                raise DuplicatedPhoneError(owner, phone.value)
+
+    def phone_owner(self, phone: str, name: str) -> str:
+        # another contact with the number as the open transaction sees the book: staged
+        # contacts stand in for their stored versions, and deleted ones hold nothing
+        owners = self.phone_owners(phone)
+        if self.in_transaction:
+            staged = self._staged_keys()
+            owners = [owner for owner in owners if owner not in staged]
+            for staged_name in sorted(staged):
+                record = self._visible(staged_name, self.data.get)
+                if record and record.find_phone(phone):
+                    owners.append(staged_name)
+        return next(filter(lambda owner: owner != name, owners), None)
+
     def add_record(self, record: Record) -> None:
+        self.__claim_phones(record, record.phones)
+        if self.in_transaction:
+            record.subscribe(self._on_staged_change)
+            self._stage(record.name.value, record)
+            self._stage_op("add_record", record)
+            return
+        self.__put(record)
+        self._journal("add_record", record)
+
+    def add_records(self, records: list) -> None:
+        if self.in_transaction:
+            for record in records:
+                record.subscribe(self._on_staged_change)
+                self._stage(record.name.value, record)
+            if records:
+                self._stage_op("add_records", records)
+            return
+        for record in records:
+            self.__put(record)
+        if records:
+            self._journal("add_records", records)
+
+    def __put(self, record: Record) -> None:
+        existing = self.data.get(record.name.value)
+        if existing:
+            existing.unsubscribe(self._on_record_change)
+            self.__index_phones(existing, index=False)
         self.data[record.name.value] = record
+        record.subscribe(self._on_record_change)
+        self.__index(record)
+        self.__index_phones(record)
+
+    def export_records(self):
+        for record in self.data.values():
+            yield record
+
+    def import_file(self, path: str, reject_path: str = None, workers: int = None) -> dict:
+        from Exchange import import_file
+        return import_file(self, path, reject_path, workers=workers)
+
+    def export_file(self, path: str) -> int:
+        from Exchange import export_file
+        return export_file(self, path)
 
     def find(self, name: str, suppress_error=False) -> Record:
-        if name in self.data.keys():
-            return self.data[name]
+        record = self._staged(name, self.data.get) if self.in_transaction else self.data.get(name)
+        if record:
+            return record
         if not suppress_error:
-            raise KeyError
+            raise KeyError(name)
+
+    def similar_names(self, name: str, limit=5) -> list:
+        names = self.__name_index()
+        if not self.in_transaction:
+            return [similar for similar in names.similar(name, limit + 1) if similar != name and similar in self.data][:limit]
+        added = NameIndex()
+        for staged_name in self._staged_keys():
+            if staged_name not in self.data:
+                added.add(staged_name)
+        candidates = names.similar(name, limit + 1) + added.similar(name, limit + 1)
+        return [similar for similar in candidates if similar != name and self._visible(similar, self.data.get)][:limit]
 
     def delete(self, name: str) -> Record:
+        if self.in_transaction:
+            record = self._staged(name, self.data.get)
+            if record:
+                self._stage(name, None, detached=True)
+                self._stage_op("delete", name)
+            return record
+        record = self.__remove(name)
+        if record:
+            self._journal("delete", name)
+        return record
+
+    def __remove(self, name: str) -> Record:
         if name in self.data.keys():
-            return self.data.pop(name)
+            record = self.data.pop(name)
+            record.unsubscribe(self._on_record_change)
+            self.__unindex(name)
+            self.__index_phones(record, index=False)
+            return record
     
-    def iterator(self, n=2, contacts: list = None):
-        counter = 0
-        values = contacts or list(self.data.values())
-        while counter < len(values):
-            yield list(map(lambda record: str(record), values[counter: counter + n]))
-            counter += n
+    def records(self, page_size=256):
+        if not self.__indexed:
+            # the storage pages through its rows by position, not with one open cursor
+            yield from self.data.scan(page_size)
+            return
+        for name in self.__order.scan():
+            # a reload from shared storage can drop names the cursor still walks
+            record = self.data.get(name)
+            if record:
+                yield record
+
+    def iterator(self, n=None, contacts = None):
+        n = n or self.page_size
+        values = iter(contacts if contacts is not None else self.records(n))
+        while page := list(islice(values, n)):
+            yield list(map(lambda record: str(record), page))
     
+    def matching_contacts(self, term:str, names: list = None):
+        # names found earlier, such as a cached result, are checked again like index candidates
+        if names is None and not self.__indexed:
+            names = self.storage.search_contacts(term)
+        elif names is None:
+            names = self.__ngram_index().candidates(term)
+            if names is None:
+                yield from self._scan_contacts(term)
+                return
+            names = sorted(names, key=self.__order.position)
+        for name in names:
+            contact = self.data.get(name)
+            if contact and contact.is_matching(term):
+                yield contact
+
+    def _scan_contacts(self, term: str):
+        return filter(lambda contact: contact.is_matching(term), self.records())
+
+    def _position(self, name: str) -> int:
+        return self.__order.position(name)
+
+    def phone_owners(self, phone: str) -> list:
+        if not self.__indexed:
+            return [name for _, name in self.storage.phone_owners(phone)]
+        return sorted(self.__phone_index().owners(Phone(phone)._get_value()), key=self.__order.position)
+
+    def phones_by_prefix(self, prefix: str):
+        # a full number is an exact lookup; shorter digit strings are treated as a prefix such as an area code
+        if not self.__indexed:
+            rows = self.storage.phone_owners(prefix)
+        elif len(prefix) == 10:
+            rows = ((prefix, name) for name in self.phone_owners(prefix))
+        else:
+            phones = self.__phone_index()
+            rows = ((f"{phone:010d}", name) for phone in phones.prefix(prefix)
+                    for name in sorted(phones.owners(phone), key=self.__order.position))
+        for phone, name in rows:
+            record = self.data.get(name)
+            if record and record.find_phone(phone):
+                yield phone, record
+
+    def duplicate_phones(self):
+        if not self.__indexed:
+            rows = self.storage.duplicate_phones()
+        else:
+            rows = sorted((Phone._from_raw(phone).value, name) for phone, names in self.__phone_index().duplicates() for name in names)
+        for phone, owners in groupby(rows, key=lambda row: row[0]):
+            yield phone, [self.data[name] for _, name in owners]
+
     def search_contacts(self, term:str) -> list:
-        contacts = filter(lambda contact: contact.is_matching(term), self.data.values())
-        return list(contacts)
+        return list(self.matching_contacts(term))
     
-    def get_contacts_by_birthdays(self, days:int):
-        contacts = filter(lambda contact: contact.days_to_birthday(), self.data.values())
-        contacts = filter(lambda contact: contact.days_to_birthday() <= days, contacts)
-        return self.iterator(contacts=list(contacts))
\ No newline at end of file
+    def upcoming_birthdays(self, days: int = None, today: date = None):
+        upcoming = self.__birthdays.upcoming if self.__indexed else self.storage.upcoming_birthdays
+        for birthday, name in upcoming(days, today):
+            yield birthday, self.data[name]
+
+    def get_contacts_by_birthdays(self, days:int, names: list = None):
+        if names is None:
+            contacts = map(lambda item: item[1], self.upcoming_birthdays(days))
+        else:
+            contacts = filter(None, map(self.data.get, names))
+        return self.iterator(contacts=contacts)
\ No newline at end of file
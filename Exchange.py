@@ -0,0 +1,178 @@
+import csv
+from collections import deque
+from itertools import islice
+from pathlib import Path
+from Contacts import AddressBook, Record, Phone, Birthday, process_pool
+
+CSV_HEADER = ["name", "phones", "birthday"]
+
+
+def read_csv(file):
+    reader = csv.reader(file)
+    for line_number, row in enumerate(reader, 1):
+        if line_number == 1 and [cell.strip().lower() for cell in row] == CSV_HEADER:
+            continue
+        if not row:
+            continue
+        name = row[0] if len(row) > 0 else ""
+        phones = row[1].split(";") if len(row) > 1 and row[1] else []
+        birthday = row[2] if len(row) > 2 and row[2] else None
+        yield line_number, name, phones, birthday, ",".join(row)
+
+
+def read_vcard(file):
+    name, phones, birthday, raw, start = "", [], None, [], 0
+    for line_number, line in enumerate(file, 1):
+        line = line.strip()
+        if not line:
+            continue
+        key, _, value = line.partition(":")
+        key = key.split(";")[0].upper()
+        if key == "BEGIN":
+            name, phones, birthday, raw, start = "", [], None, [], line_number
+        raw.append(line)
+        if key == "FN":
+            name = value
+        elif key == "TEL":
+            phones.append(value)
+        elif key == "BDAY":
+            # vCard dates are YYYY-MM-DD or YYYYMMDD, the book uses DD-MM-YYYY
+            value = value.replace("-", "")
+            birthday = f"{value[6:8]}-{value[4:6]}-{value[:4]}" if len(value) == 8 else value
+        elif key == "END":
+            yield start, name, phones, birthday, "\n".join(raw)
+
+
+def write_csv(records, file) -> int:
+    writer = csv.writer(file)
+    writer.writerow(CSV_HEADER)
+    count = 0
+    for record in records:
+        birthday = record.birthday.value if isinstance(record.birthday, Birthday) else ""
+        writer.writerow([record.name.value, ";".join(phone.value for phone in record.phones), birthday])
+        count += 1
+    return count
+
+
+def write_vcard(records, file) -> int:
+    count = 0
+    for record in records:
+        file.write("BEGIN:VCARD\nVERSION:3.0\n")
+        file.write(f"FN:{record.name.value}\n")
+        for phone in record.phones:
+            file.write(f"TEL;TYPE=CELL:{phone.value}\n")
+        if isinstance(record.birthday, Birthday):
+            file.write(f"BDAY:{record.birthday.date.isoformat()}\n")
+        file.write("END:VCARD\n")
+        count += 1
+    return count
+
+
+READERS = {".csv": read_csv, ".vcf": read_vcard}
+WRITERS = {".csv": write_csv, ".vcf": write_vcard}
+
+
+def import_rows(book: AddressBook, rows, rejects=None, chunk_size=10000, workers=None) -> dict:
+    report = {"added": 0, "updated": 0, "rejected": 0, "duplicates": 0}
+    rows = iter(rows)
+    if not workers or workers == 1:
+        while chunk := list(islice(rows, chunk_size)):
+            _import_chunk(book, chunk, rejects, report, validate_columns(*_columns(chunk)))
+        return report
+    # workers validate the next chunks while this process applies the current one;
+    # at most `workers` chunks are read ahead, so memory stays bounded
+    with process_pool(workers) as pool:
+        pending = deque()
+        while True:
+            while len(pending) < workers and (chunk := list(islice(rows, chunk_size))):
+                pending.append((chunk, pool.submit(validate_columns, *_columns(chunk))))
+            if not pending:
+                return report
+            chunk, validated = pending.popleft()
+            _import_chunk(book, chunk, rejects, report, validated.result())
+
+
+def _columns(chunk: list) -> tuple:
+    phones = [phone.strip() for _, _, phones, _, _ in chunk for phone in phones]
+    birthdays = [birthday.strip() if birthday else "" for _, _, _, birthday, _ in chunk]
+    return phones, birthdays
+
+
+def validate_columns(phones: list, birthdays: list) -> tuple:
+    return Phone.normalize_column(phones), Birthday.parse_column(birthdays)
+
+
+def _reject(rejects, report: dict, line_number: int, reason: str, raw: str, duplicate=False) -> None:
+    report["duplicates" if duplicate else "rejected"] += 1
+    if rejects:
+        rejects.writerow([line_number, reason, raw])
+
+
+def _phone_owner(book: AddressBook, claimed: dict, phone: str, name: str) -> str:
+    # numbers taken by new contacts of this chunk are not in the book's index until add_records
+    if phone not in claimed:
+        return book.phone_owner(phone, name)
+    return claimed[phone] if claimed[phone] != name else None
+
+
+def _import_chunk(book: AddressBook, chunk: list, rejects, report: dict, validated: tuple) -> None:
+    normalized_phones, birthdays = validated
+    normalized_phones = iter(normalized_phones)
+    raw_phones = iter(phone.strip() for _, _, phones, _, _ in chunk for phone in phones)
+    new_records = {}
+    claimed = {}
+    for (line_number, name, phones, birthday, raw), parsed_birthday in zip(chunk, birthdays):
+        row_phones = [(next(raw_phones), next(normalized_phones)) for _ in phones]
+        name = name.strip().lower().title()
+        if not name:
+            _reject(rejects, report, line_number, "Contact name is missing", raw)
+            continue
+        invalid = [raw_phone for raw_phone, phone in row_phones if phone is None]
+        if invalid:
+            _reject(rejects, report, line_number, f"Phone number '{invalid[0]}' is incorrect", raw)
+            continue
+        if birthday and parsed_birthday is None:
+            _reject(rejects, report, line_number, f"Birthday '{birthday}' format is incorrect", raw)
+            continue
+        record = new_records.get(name)
+        existing = None if record else book.find(name, True)
+        if not record and not existing:
+            record = new_records[name] = Record(name)
+        target = record or existing
+        for _, phone in row_phones:
+            owner = book.unique_phones and _phone_owner(book, claimed, phone, name)
+            if target.find_phone(phone):
+                _reject(rejects, report, line_number, f"Phone number {phone} already exists for contact {name}", raw, True)
+            elif owner:
+                _reject(rejects, report, line_number, f"Phone number {phone} already exists for contact {owner}", raw, True)
+            elif record:
+                record.phones.append(Phone.trusted(phone))
+                claimed[phone] = name
+            else:
+                existing.add_phone(phone)
+        if parsed_birthday:
+            if record:
+                record.birthday = Birthday.trusted(*parsed_birthday)
+            else:
+                existing.add_birthday(birthday.strip())
+        if existing:
+            report["updated"] += 1
+    book.add_records(list(new_records.values()))
+    report["added"] += len(new_records)
+
+
+def import_file(book: AddressBook, path: str, reject_path: str = None, chunk_size=10000, workers=None) -> dict:
+    reader = READERS.get(Path(path).suffix.lower(), read_csv)
+    with open(path, newline="", encoding="utf-8") as file:
+        if not reject_path:
+            return import_rows(book, reader(file), None, chunk_size, workers)
+        with open(reject_path, "w", newline="", encoding="utf-8") as reject_file:
+            rejects = csv.writer(reject_file)
+            rejects.writerow(["line", "reason", "row"])
+            return import_rows(book, reader(file), rejects, chunk_size, workers)
+
+
+def export_file(book: AddressBook, path: str) -> int:
+    writer = WRITERS.get(Path(path).suffix.lower(), write_csv)
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        return writer(book.export_records(), file)
@@ -0,0 +1,578 @@
+import heapq
+import math
+import re
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, defaultdict
+from datetime import date
+from itertools import count, islice, product
+from Suggestions import DeletionIndex, edit_distance
+
+# Soundex-style consonant classes; vowels and h, w, y only separate repeated codes
+PHONETIC_CODES = {letter: str(code) for code, letters in enumerate(("aeiouyhw", "bfpv", "cgjkqsxz", "dt", "l", "mn", "r")) for letter in letters}
+# silent leading letters, as in Knight, Gnome, Wright, Psalm and Pneuma
+SILENT_PREFIXES = ("kn", "gn", "wr", "ps", "pn")
+PHONETIC_TABLE = str.maketrans(PHONETIC_CODES)
+REPEATED_CODE_REG_EXP = re.compile(r"(\d)\1+")
+
+
+class NgramIndex:
+    def __init__(self, n=3) -> None:
+        self.__n = n
+        self.__postings = defaultdict(set)
+        self.__grams = {}
+
+    def __split(self, text: str) -> set:
+        n = self.__n
+        return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+    def add(self, key, *texts) -> None:
+        grams = set()
+        for text in texts:
+            grams |= self.__split(text)
+        self.__grams[key] = grams
+        for gram in grams:
+            self.__postings[gram].add(key)
+
+    def remove(self, key) -> None:
+        for gram in self.__grams.pop(key, ()):
+            posting = self.__postings[gram]
+            posting.discard(key)
+            if not posting:
+                del self.__postings[gram]
+
+    def update(self, key, *texts) -> None:
+        self.remove(key)
+        self.add(key, *texts)
+
+    def candidates(self, term: str) -> set:
+        if len(term) < self.__n:
+            return None
+        postings = []
+        for gram in self.__split(term):
+            posting = self.__postings.get(gram)
+            if not posting:
+                return set()
+            postings.append(posting)
+        postings.sort(key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            result &= posting
+            if not result:
+                break
+        return result
+
+
+class TagIndex:
+    def __init__(self) -> None:
+        self.__items = defaultdict(dict)
+        self.__ordered = {}
+
+    def add(self, item, tags: dict) -> None:
+        for tag, count in tags.items():
+            self.__items[tag][item] = count
+            self.__ordered.pop(tag, None)
+
+    def remove(self, item, tags: dict) -> None:
+        for tag in tags:
+            items = self.__items.get(tag)
+            if items is None:
+                continue
+            items.pop(item, None)
+            if not items:
+                del self.__items[tag]
+            self.__ordered.pop(tag, None)
+
+    def counts(self, tag: str) -> dict:
+        return self.__items.get(tag, {})
+
+    def ordered(self, tag: str) -> list:
+        ordered = self.__ordered.get(tag)
+        if ordered is None:
+            items = self.__items.get(tag, {})
+            ordered = sorted(items, key=items.__getitem__, reverse=True)
+            self.__ordered[tag] = ordered
+        return ordered
+
+
+class TagStats:
+    # collection-wide tag analytics, kept current from the difference between a note's old and new tags
+    def __init__(self) -> None:
+        self.__notes = Counter()
+        self.__uses = Counter()
+        self.__pairs = defaultdict(Counter)
+        # key -> None per tag, in the order the key last gained or changed the tag
+        self.__recent = defaultdict(dict)
+
+    def __len__(self) -> int:
+        return len(self.__notes)
+
+    def add(self, key, tags: dict) -> None:
+        self.update(key, {}, tags)
+
+    def remove(self, key, tags: dict) -> None:
+        self.update(key, tags, {})
+
+    def update(self, key, old: dict, new: dict) -> None:
+        dropped = old.keys() - new.keys()
+        added = new.keys() - old.keys()
+        for tag in dropped:
+            self.__bump(self.__notes, tag, -1)
+            self.__bump(self.__uses, tag, -old[tag])
+            recent = self.__recent[tag]
+            recent.pop(key, None)
+            if not recent:
+                del self.__recent[tag]
+        for tag, uses in new.items():
+            if tag in added:
+                self.__bump(self.__notes, tag, 1)
+            self.__bump(self.__uses, tag, uses - old.get(tag, 0))
+            recent = self.__recent[tag]
+            recent.pop(key, None)
+            recent[key] = None
+        self.__link(old, dropped, -1)
+        self.__link(new, added, 1)
+
+    def __link(self, tags: dict, changed: set, delta: int) -> None:
+        # only pairs with a changed tag move; a pair of two changed tags is counted once
+        for tag in changed:
+            for other in tags:
+                if other != tag and (other not in changed or other > tag):
+                    self.__bump(self.__pairs[tag], other, delta)
+                    self.__bump(self.__pairs[other], tag, delta)
+                    for key in (tag, other):
+                        if not self.__pairs[key]:
+                            del self.__pairs[key]
+
+    @staticmethod
+    def __bump(counter: Counter, key, delta: int) -> None:
+        counter[key] += delta
+        if counter[key] <= 0:
+            del counter[key]
+
+    def frequency(self, tag: str) -> tuple:
+        return self.__notes.get(tag, 0), self.__uses.get(tag, 0)
+
+    def top(self, k=10) -> list:
+        return heapq.nsmallest(k, self.__notes, key=lambda tag: (-self.__notes[tag], -self.__uses[tag], tag))
+
+    def related(self, tag: str, k=5) -> list:
+        pairs = self.__pairs.get(tag)
+        return pairs.most_common(k) if pairs else []
+
+    def recent(self, tag: str, k=5) -> list:
+        return list(islice(reversed(self.__recent.get(tag, {})), k))
+
+
+class OrderIndex:
+    def __init__(self) -> None:
+        self.__positions = {}
+        self.__keys = {}
+        self.__order = []
+        self.__counter = count()
+        self.__removed = 0
+        self.__version = 0
+
+    def __len__(self) -> int:
+        return len(self.__positions)
+
+    def __contains__(self, key) -> bool:
+        return key in self.__positions
+
+    def add(self, key) -> None:
+        if key in self.__positions:
+            return
+        position = next(self.__counter)
+        self.__positions[key] = position
+        self.__keys[position] = key
+        self.__order.append(position)
+
+    def remove(self, key) -> None:
+        position = self.__positions.pop(key, None)
+        if position is None:
+            return
+        # leave a tombstone so the list never shifts under a running scan
+        del self.__keys[position]
+        self.__removed += 1
+        if self.__removed > 1024 and self.__removed * 2 > len(self.__order):
+            self.__order = [position for position in self.__order if position in self.__keys]
+            self.__removed = 0
+            self.__version += 1
+
+    def rename(self, old_key, new_key) -> None:
+        position = self.__positions.pop(old_key)
+        self.__positions[new_key] = position
+        self.__keys[position] = new_key
+
+    def position(self, key) -> int:
+        return self.__positions[key]
+
+    def scan(self, cursor: int = -1):
+        # the cursor is the last position seen, so keys added or removed between
+        # steps never make the scan skip or repeat a live key
+        version, idx = None, 0
+        while True:
+            if version != self.__version:
+                version, idx = self.__version, bisect_right(self.__order, cursor)
+            if idx >= len(self.__order):
+                return
+            cursor = self.__order[idx]
+            idx += 1
+            key = self.__keys.get(cursor)
+            if key is not None:
+                yield key
+
+
+class PhoneIndex:
+    def __init__(self, width=10) -> None:
+        self.__width = width
+        # phone -> its owner key, or a set once several keys share it; an empty set
+        # marks a stale phone that is still sitting in the sorted list
+        self.__owners = {}
+        self.__sorted = []
+        self.__pending = []
+        self.__stale = 0
+
+    def add(self, phone, key) -> None:
+        owners = self.__owners.get(phone)
+        if owners is None:
+            self.__owners[phone] = key
+            if isinstance(phone, int):
+                self.__pending.append(phone)
+                # merging on writes keeps lookups free of mutation, so concurrent readers are safe
+                if len(self.__pending) > 256 + len(self.__sorted) // 8:
+                    self.__rebuild()
+        elif not isinstance(owners, set):
+            if owners != key:
+                self.__owners[phone] = {owners, key}
+        elif owners:
+            owners.add(key)
+        else:
+            self.__owners[phone] = key
+            self.__stale -= 1
+
+    def remove(self, phone, key) -> None:
+        owners = self.__owners.get(phone)
+        if owners is None or owners != key and not (isinstance(owners, set) and key in owners):
+            return
+        if isinstance(owners, set) and len(owners) > 1:
+            owners.discard(key)
+            if len(owners) == 1:
+                self.__owners[phone] = owners.pop()
+        elif not isinstance(phone, int):
+            del self.__owners[phone]
+        else:
+            self.__owners[phone] = set()
+            self.__stale += 1
+            if self.__stale > 1024 and self.__stale * 2 > len(self.__owners):
+                self.__rebuild()
+
+    def __rebuild(self) -> None:
+        phones = self.__sorted + self.__pending
+        if self.__stale:
+            for phone in [phone for phone, owners in self.__owners.items() if owners == set()]:
+                del self.__owners[phone]
+            phones = [phone for phone in phones if phone in self.__owners]
+        # the list is one sorted run plus the pending tail, which timsort merges in about linear time
+        phones.sort()
+        self.__sorted = phones
+        self.__pending = []
+        self.__stale = 0
+
+    def owners(self, phone) -> set:
+        owners = self.__owners.get(phone)
+        if owners is None:
+            return set()
+        return set(owners) if isinstance(owners, set) else {owners}
+
+    def prefix(self, digits: str) -> list:
+        # ten-digit phones are ints, so a digit prefix is the integer range [prefix, prefix + 1) * 10^rest
+        scale = 10 ** (self.__width - len(digits))
+        low, high = int(digits) * scale, (int(digits) + 1) * scale
+        phones, pending = self.__sorted, self.__pending
+        found = phones[bisect_left(phones, low):bisect_left(phones, high)]
+        found += [phone for phone in pending if low <= phone < high]
+        return sorted(phone for phone in set(found) if self.__owners.get(phone) != set())
+
+    def duplicates(self):
+        for phone, owners in self.__owners.items():
+            if isinstance(owners, set) and len(owners) > 1:
+                yield phone, set(owners)
+
+
+def phonetic_key(word: str, length=6) -> str:
+    # unlike Soundex the first letter is coded too, so Catherine and Katherine share a key;
+    # words with letters outside the Latin alphabet get no key
+    word = word.casefold()
+    if word.startswith(SILENT_PREFIXES):
+        word = word[1:]
+    if not (word.isascii() and word.isalpha()):
+        return None
+    codes = REPEATED_CODE_REG_EXP.sub(lambda repeated: repeated[1], word.translate(PHONETIC_TABLE))
+    return (codes[0] + codes[1:].replace("0", ""))[:length]
+
+
+class NameIndex:
+    # a name is stored under its casefolded words and under their phonetic keys: typos are
+    # looked up per word in a deletion index over the distinct words, which stay far fewer than
+    # the names, and the similar words are then combined into whole spellings to look up
+    __word_reg_exp = re.compile(r"\w+")
+
+    def __init__(self, max_distance=1, max_spellings=4096) -> None:
+        self.__max_distance = max_distance
+        self.__max_spellings = max_spellings
+        self.__words = DeletionIndex(max_distance)
+        self.__word_counts = defaultdict(int)
+        self.__word_sounds = {}
+        # spelling or sound -> the name, or a set once several names share it
+        self.__spellings = {}
+        self.__sounds = {}
+
+    def __len__(self) -> int:
+        return sum(len(names) if isinstance(names, set) else 1 for names in self.__spellings.values())
+
+    @classmethod
+    def split(cls, name: str) -> tuple:
+        return tuple(cls.__word_reg_exp.findall(name.casefold()))
+
+    @staticmethod
+    def __sound(keys: tuple) -> tuple:
+        # a name only has a sound when every word has a phonetic key
+        return keys if keys and None not in keys else None
+
+    @staticmethod
+    def __put(table: dict, key, name: str) -> bool:
+        names = table.get(key)
+        if names is None:
+            table[key] = name
+        elif isinstance(names, set):
+            if name in names:
+                return False
+            names.add(name)
+        elif names == name:
+            return False
+        else:
+            table[key] = {names, name}
+        return True
+
+    @staticmethod
+    def __drop(table: dict, key, name: str) -> bool:
+        names = table.get(key)
+        if isinstance(names, set) and name in names:
+            names.discard(name)
+            if len(names) == 1:
+                table[key] = names.pop()
+        elif names == name:
+            del table[key]
+        else:
+            return False
+        return True
+
+    @staticmethod
+    def __names(table: dict, key) -> tuple:
+        names = table.get(key)
+        if names is None:
+            return ()
+        return tuple(names) if isinstance(names, set) else (names,)
+
+    def add(self, name: str) -> None:
+        words = self.split(name)
+        if not self.__put(self.__spellings, " ".join(words), name):
+            return
+        for word in words:
+            if not self.__word_counts[word]:
+                self.__words.add(word)
+                self.__word_sounds[word] = phonetic_key(word)
+            self.__word_counts[word] += 1
+        sound = self.__sound(tuple(map(self.__word_sounds.__getitem__, words)))
+        if sound:
+            self.__put(self.__sounds, sound, name)
+
+    def remove(self, name: str) -> None:
+        words = self.split(name)
+        if not self.__drop(self.__spellings, " ".join(words), name):
+            return
+        sound = self.__sound(tuple(map(self.__word_sounds.__getitem__, words)))
+        if sound:
+            self.__drop(self.__sounds, sound, name)
+        for word in words:
+            self.__word_counts[word] -= 1
+            if not self.__word_counts[word]:
+                del self.__word_counts[word]
+                del self.__word_sounds[word]
+                self.__words.remove(word)
+
+    def similar(self, name: str, limit=5) -> list:
+        words = self.split(name)
+        if not words:
+            return []
+        found = self.__typos(words)[:limit]
+        if len(found) < limit:
+            found += self.__sound_alikes(words, found, limit - len(found))
+        return found
+
+    def __typos(self, words: tuple) -> list:
+        typos = [{word: distance for distance, word in self.__words.search(word, self.__max_distance)} for word in words]
+        # every combination of similar words is one spelling lookup; the closest words come
+        # first, and names of many common words stop after a bounded number of lookups
+        choices = [sorted(similar, key=lambda word: (similar[word], word)) for similar in typos]
+        scored = []
+        for spelling in islice(product(*choices), self.__max_spellings):
+            names = self.__names(self.__spellings, " ".join(spelling))
+            if names:
+                distance = sum(map(dict.__getitem__, typos, spelling))
+                scored += ((distance, name) for name in names)
+        scored.sort()
+        return [name for _, name in scored]
+
+    def __sound_alikes(self, words: tuple, found: list, limit: int) -> list:
+        # sound-alikes rank after the typos, by how far apart the spellings are; the bound
+        # tightens as better ones turn up, so most distances stop after a few letters
+        query = " ".join(words)
+        best = []
+        for name in self.__names(self.__sounds, self.__sound(tuple(map(phonetic_key, words)))):
+            if name in found:
+                continue
+            bound = best[-1][0] if len(best) == limit else len(query)
+            distance = edit_distance(query, " ".join(self.split(name)), bound)
+            if distance <= bound:
+                insort(best, (distance, name))
+                del best[limit:]
+        return [name for _, name in best]
+
+
+def birthday_in_year(month: int, day: int, year: int) -> date:
+    if month == 2 and day == 29 and not (year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)):
+        return date(year, 2, 28)
+    return date(year, month, day)
+
+
+def next_birthday(month: int, day: int, today: date) -> date:
+    birthday = birthday_in_year(month, day, today.year)
+    if birthday < today:
+        birthday = birthday_in_year(month, day, today.year + 1)
+    return birthday
+
+
+class BirthdayIndex:
+    def __init__(self) -> None:
+        self.__calendar = []
+        self.__entries = {}
+
+    @classmethod
+    def bulk(cls, entries) -> "BirthdayIndex":
+        # one sort for a whole book; add keeps the calendar sorted with an insort per entry
+        index = cls()
+        index.__entries = {key: (month, day, key) for key, month, day in entries}
+        index.__calendar = sorted(index.__entries.values())
+        return index
+
+    def __len__(self) -> int:
+        return len(self.__calendar)
+
+    def add(self, key, month: int, day: int) -> None:
+        self.remove(key)
+        entry = (month, day, key)
+        self.__entries[key] = entry
+        insort(self.__calendar, entry)
+
+    def remove(self, key) -> None:
+        entry = self.__entries.pop(key, None)
+        if entry:
+            del self.__calendar[bisect_left(self.__calendar, entry)]
+
+    def upcoming(self, days: int = None, today: date = None):
+        today = today or date.today()
+        start = (today.month, today.day)
+        # the cursor is the last yielded entry, so inserts and deletes between
+        # steps never make the generator skip or repeat a contact
+        cursor = start
+        wrapped = False
+        while True:
+            idx = bisect_right(self.__calendar, cursor) if cursor != start else bisect_left(self.__calendar, start)
+            if idx >= len(self.__calendar):
+                if wrapped:
+                    return
+                wrapped, cursor = True, (0,)
+                continue
+            entry = self.__calendar[idx]
+            if wrapped and entry[:2] >= start:
+                return
+            month, day, key = entry
+            birthday = next_birthday(month, day, today)
+            if days is not None and (birthday - today).days > days:
+                return
+            yield birthday, key
+            cursor = entry
+
+
+class FullTextIndex:
+    __token_reg_exp = re.compile(r"\w+")
+
+    def __init__(self, k1=1.2, b=0.75) -> None:
+        self.__k1 = k1
+        self.__b = b
+        self.__postings = defaultdict(dict)
+        self.__documents = {}
+        self.__lengths = {}
+        self.__total_length = 0
+        self.__vocabulary = NgramIndex()
+
+    @classmethod
+    def tokenize(cls, text: str) -> list:
+        return cls.__token_reg_exp.findall(text.casefold())
+
+    def add(self, doc, *texts) -> None:
+        frequencies = defaultdict(int)
+        for text in texts:
+            for token in self.tokenize(text):
+                frequencies[token] += 1
+        self.__documents[doc] = frequencies
+        self.__lengths[doc] = sum(frequencies.values())
+        self.__total_length += self.__lengths[doc]
+        for token, frequency in frequencies.items():
+            posting = self.__postings[token]
+            if not posting:
+                self.__vocabulary.add(token, token)
+            posting[doc] = frequency
+
+    def remove(self, doc) -> None:
+        frequencies = self.__documents.pop(doc, None)
+        if frequencies is None:
+            return
+        self.__total_length -= self.__lengths.pop(doc)
+        for token in frequencies:
+            posting = self.__postings[token]
+            posting.pop(doc, None)
+            if not posting:
+                del self.__postings[token]
+                self.__vocabulary.remove(token)
+
+    def update(self, doc, *texts) -> None:
+        self.remove(doc)
+        self.add(doc, *texts)
+
+    def expand(self, term: str) -> set:
+        # a query token matches every indexed token that contains it, like the old substring search
+        tokens = self.__vocabulary.candidates(term)
+        if tokens is None:
+            tokens = self.__postings.keys()
+        return {token for token in tokens if term in token}
+
+    def search(self, query_terms) -> list:
+        tokens = set()
+        for term in query_terms:
+            for query_token in self.tokenize(term):
+                tokens |= self.expand(query_token)
+        if not tokens:
+            return []
+        count = len(self.__documents)
+        average_length = self.__total_length / count if count else 0
+        scores = defaultdict(float)
+        for token in tokens:
+            posting = self.__postings[token]
+            idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc, frequency in posting.items():
+                length = self.__lengths[doc]
+                norm = self.__k1 * (1 - self.__b + self.__b * length / average_length) if average_length else self.__k1
+                scores[doc] += idf * frequency * (self.__k1 + 1) / (frequency + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,75 @@
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class ReadWriteLock:
+    def __init__(self) -> None:
+        self.__condition = threading.Condition(threading.Lock())
+        self.__readers = 0
+        self.__writer = False
+        self.__waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self.__condition:
+            # waiting writers go first so a steady stream of reads cannot starve them
+            while self.__writer or self.__waiting_writers:
+                self.__condition.wait()
+            self.__readers += 1
+        try:
+            yield
+        finally:
+            with self.__condition:
+                self.__readers -= 1
+                if not self.__readers:
+                    self.__condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.__condition:
+            self.__waiting_writers += 1
+            while self.__writer or self.__readers:
+                self.__condition.wait()
+            self.__waiting_writers -= 1
+            self.__writer = True
+        try:
+            yield
+        finally:
+            with self.__condition:
+                self.__writer = False
+                self.__condition.notify_all()
+
+
+class FileLock:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.__file = None
+        self.__depth = 0
+        self.__lock = threading.RLock()
+
+    @contextmanager
+    def hold(self):
+        # advisory lock shared by every process using the file; nested holds in one process just count
+        with self.__lock:
+            if not self.__depth:
+                if fcntl is None:
+                    raise OSError("Shared storage needs POSIX file locks.")
+                self.__file = self.__file or open(self.path, "ab")
+                fcntl.flock(self.__file, fcntl.LOCK_EX)
+            self.__depth += 1
+            try:
+                yield
+            finally:
+                self.__depth -= 1
+                if not self.__depth:
+                    fcntl.flock(self.__file, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        if self.__file:
+            self.__file.close()
+            self.__file = None
@@ -0,0 +1,127 @@
+import json
+import threading
+from bisect import bisect_left
+
+# latency buckets from 1 microsecond doubling up to about 18 minutes
+BUCKETS = [2 ** exponent / 1_000_000 for exponent in range(31)]
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.__buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.__buckets[bisect_left(BUCKETS, seconds)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        rank = fraction * self.count
+        seen = 0
+        for idx, count in enumerate(self.__buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(BUCKETS[idx], self.max) if idx < len(BUCKETS) else self.max
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets": {str(BUCKETS[idx]) if idx < len(BUCKETS) else "inf": count for idx, count in enumerate(self.__buckets) if count},
+        }
+
+
+class CommandStats:
+    def __init__(self) -> None:
+        self.errors = 0
+        self.latency = Histogram()
+
+    def to_dict(self) -> dict:
+        return {"count": self.latency.count, "errors": self.errors, "latency": self.latency.to_dict()}
+
+
+class StorageStats:
+    def __init__(self) -> None:
+        self.duration = Histogram()
+        self.bytes = 0
+
+    def to_dict(self) -> dict:
+        return {"count": self.duration.count, "bytes": self.bytes, "duration": self.duration.to_dict()}
+
+
+class Metrics:
+    def __init__(self, enabled=False) -> None:
+        self.enabled = enabled
+        self.__lock = threading.Lock()
+        self.__commands = {}
+        self.__stages = {}
+        self.__storage = {}
+
+    def command(self, name: str, seconds: float, failed=False) -> None:
+        with self.__lock:
+            stats = self.__commands.get(name) or self.__commands.setdefault(name, CommandStats())
+            stats.latency.observe(seconds)
+            if failed:
+                stats.errors += 1
+
+    def error(self, name: str) -> None:
+        with self.__lock:
+            stats = self.__commands.get(name) or self.__commands.setdefault(name, CommandStats())
+            stats.errors += 1
+
+    def stage(self, name: str, seconds: float) -> None:
+        with self.__lock:
+            histogram = self.__stages.get(name) or self.__stages.setdefault(name, Histogram())
+            histogram.observe(seconds)
+
+    def storage(self, name: str, operation: str, seconds: float, size: int) -> None:
+        key = f"{name}.{operation}"
+        with self.__lock:
+            stats = self.__storage.get(key) or self.__storage.setdefault(key, StorageStats())
+            stats.duration.observe(seconds)
+            stats.bytes = size
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.__commands.clear()
+            self.__stages.clear()
+            self.__storage.clear()
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            return {
+                "commands": {name: stats.to_dict() for name, stats in sorted(self.__commands.items())},
+                "stages": {name: histogram.to_dict() for name, histogram in sorted(self.__stages.items())},
+                "storage": {name: stats.to_dict() for name, stats in sorted(self.__storage.items())},
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def dump(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(self.to_json())
+
+    def report(self) -> str:
+        snapshot = self.snapshot()
+        lines = [f"{'command':<12} {'count':>8} {'errors':>7} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+        for name, stats in snapshot["commands"].items():
+            latency = stats["latency"]
+            lines.append(f"{name:<12} {stats['count']:>8} {stats['errors']:>7} {latency['mean'] * 1000:>9.3f} {latency['p50'] * 1000:>9.3f} {latency['p99'] * 1000:>9.3f} {latency['max'] * 1000:>9.3f}")
+        for name, latency in snapshot["stages"].items():
+            lines.append(f"{name:<12} {latency['count']:>8} {'':>7} {latency['mean'] * 1000:>9.3f} {latency['p50'] * 1000:>9.3f} {latency['p99'] * 1000:>9.3f} {latency['max'] * 1000:>9.3f}")
+        for name, stats in snapshot["storage"].items():
+            duration = stats["duration"]
+            lines.append(f"{name}: {stats['count']} times, last {stats['bytes']} bytes, mean {duration['mean'] * 1000:.3f} ms, max {duration['max'] * 1000:.3f} ms")
+        return "\n".join(lines)
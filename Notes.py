@@ -1,24 +1,46 @@
 import re
-from collections import UserList
+from collections import Counter, UserList
+from itertools import chain, islice
 from typing import Iterator
 from datetime import datetime
 from Serialization import Serializable
+from Indexes import TagIndex, TagStats, FullTextIndex, OrderIndex
 
 class Note:
-    __tags_reg_exp = r"#\w+"
+    __tags_reg_exp = re.compile(r"#\w+")
 
     def __init__(self, title: str, text: str):
         self.__title: str = None
         self.__tags = {}
         self.__text: str = None
         self.__modified: datetime.now
+        self.__listeners = []
         self.title = title        
         self.text = text                      
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.pop("_Note__listeners", None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.__listeners = []
+
+    def subscribe(self, listener) -> None:
+        self.__listeners.append(listener)
+
+    def unsubscribe(self, listener) -> None:
+        if listener in self.__listeners:
+            self.__listeners.remove(listener)
+
+    def _notify(self, event: str, *args) -> None:
+        for listener in self.__listeners:
+            listener(self, event, *args)
     
     def __parse_tags(self, value):
-        all_tags = re.findall(self.__tags_reg_exp, value)
-        unique_tags = set(all_tags)
-        self.__tags = {tag.removeprefix("#").lower():all_tags.count(tag) for tag in unique_tags}
+        # one counting pass; #Car and #car count as the same tag
+        self.__tags = dict(Counter(tag[1:].lower() for tag in self.__tags_reg_exp.findall(value)))
 
     @property
     def text(self):
@@ -26,9 +48,11 @@ class Note:
     
     @text.setter
     def text(self, value):
+        old_tags = self.__tags
         self.__text = value        
         self.__parse_tags(value)
         self.__modified = datetime.now
+        self._notify("text", old_tags)
     
     @property
     def modified(self):
@@ -44,7 +68,9 @@ class Note:
     
     @title.setter
     def title(self, value):
+        old_title = self.__title
         self.__title = value
+        self._notify("title", old_title)
 
     def __str__(self) -> str:
         return f"{self.title}:\n\t{self.text}"
@@ -55,55 +81,260 @@ class Note:
     
 class Notes (UserList, Serializable):
     def __init__(self, file_name) -> None:        
+        self.__titles = {}
+        self.__positions = {}
+        self.__order = OrderIndex()
+        self.__tags = TagIndex()
+        self.__fulltext = FullTextIndex()
+        self.__tag_stats = TagStats()
+        self.__indexed = True
+        self.page_size = 2
         UserList.__init__(self)
         Serializable.__init__(self, file_name)
 
+    @classmethod
+    def storage_class(cls, kind: str) -> type:
+        if kind == "sqlite":
+            from SqlStorage import NotesSqlStorage
+            return NotesSqlStorage
+        if kind == "snapshot":
+            from Snapshot import NotesSnapshotStorage
+            return NotesSnapshotStorage
+        return super().storage_class(kind)
+
+    def _set_state(self, data) -> None:
+        super()._set_state(data)
+        self.__titles = {}
+        self.__positions = {}
+        self.__order = OrderIndex()
+        self.__tags = TagIndex()
+        # like the contact indexes, full-text search is only built by the first search
+        self.__fulltext = None
+        self.__indexed = not getattr(data, "lazy", False)
+        self.__tag_stats = TagStats() if self.__indexed else None
+        if self.__indexed:
+            for idx, note in enumerate(self.data):
+                self.__index(note, idx)
+
+    def _get_state(self):
+        if not self.__indexed:
+            return self.data
+        # deletions reorder the list, so notes are saved in the order they were added
+        return list(self.notes())
+
+    def _attach(self, note: Note) -> None:
+        note.subscribe(self._on_note_change)
+
+    def __index(self, note: Note, idx: int) -> None:
+        if self.__tag_stats is not None:
+            self.__tag_stats.add(note.title, note.tags)
+        if not self.__indexed:
+            self._attach(note)
+            return
+        self.__titles[note.title] = note
+        self.__positions[note.title] = idx
+        self.__order.add(note.title)
+        self.__tags.add(note, note.tags)
+        if self.__fulltext is not None:
+            self.__fulltext.add(note, note.title, note.text)
+        note.subscribe(self._on_note_change)
+
+    def __fulltext_index(self) -> FullTextIndex:
+        if self.__fulltext is None:
+            fulltext = FullTextIndex()
+            for note in self.data:
+                fulltext.add(note, note.title, note.text)
+            self.__fulltext = fulltext
+        return self.__fulltext
+
+    def _on_note_change(self, note: Note, event: str, *args) -> None:
+        if self.__tag_stats is not None:
+            if event == "text":
+                self.__tag_stats.update(note.title, args[0], note.tags)
+            elif event == "title":
+                self.__tag_stats.remove(args[0], note.tags)
+                self.__tag_stats.add(note.title, note.tags)
+        if not self.__indexed:
+            if event == "text":
+                self._journal("edit_note", note.title, note.text)
+            return
+        if event == "text":
+            old_tags = args[0]
+            self.__tags.remove(note, old_tags)
+            self.__tags.add(note, note.tags)
+            if self.__fulltext is not None:
+                self.__fulltext.update(note, note.title, note.text)
+            self._journal("edit_note", note.title, note.text)
+        elif event == "title":
+            old_title = args[0]
+            if self.__fulltext is not None:
+                self.__fulltext.update(note, note.title, note.text)
+            self.__titles[note.title] = self.__titles.pop(old_title)
+            self.__positions[note.title] = self.__positions.pop(old_title)
+            self.__order.rename(old_title, note.title)
+
+    def _on_staged_change(self, note: Note, event: str, *args) -> None:
+        if event == "text":
+            self._stage_op("edit_note", note.title, note.text)
+
+    def _copy(self, note: Note) -> Note:
+        copy = Note.__new__(Note)
+        copy.__setstate__(note.__getstate__())
+        copy.subscribe(self._on_staged_change)
+        return copy
+
+    def _apply(self, staged: dict) -> None:
+        for title, (note, detached, _) in staged.items():
+            if note is not None:
+                note.unsubscribe(self._on_staged_change)
+            if note is not None and not detached and self.__indexed:
+                self.__replace(note)
+                continue
+            self.__remove(title)
+            if note is not None:
+                self.append(note)
+                self.__index(note, len(self.data) - 1 if self.__indexed else None)
+
+    def __replace(self, note: Note) -> None:
+        old = self.__titles[note.title]
+        old.unsubscribe(self._on_note_change)
+        self.__tag_stats.update(note.title, old.tags, note.tags)
+        self.__tags.remove(old, old.tags)
+        self.data[self.__positions[note.title]] = note
+        self.__titles[note.title] = note
+        self.__tags.add(note, note.tags)
+        if self.__fulltext is not None:
+            self.__fulltext.remove(old)
+            self.__fulltext.add(note, note.title, note.text)
+        note.subscribe(self._on_note_change)
+
     def add_note(self, note:Note):
+        if self[note.title]:
+            self.delete_note(note.title)
+        if self.in_transaction:
+            note.subscribe(self._on_staged_change)
+            self._stage(note.title, note, detached=True)
+            self._stage_op("add_note", note)
+            return
         self.append(note)
+        self.__index(note, len(self.data) - 1 if self.__indexed else None)
+        self._journal("add_note", note)
     
     def edit_note(self, title:str, text:str):
-        notes = list(filter(lambda note: title == note.title, self.data)) 
-        if notes:
-            notes[0].text = text
+        note = self[title]
+        if note:
+            note.text = text
     
     def delete_note(self, title:str):
-        notes = list(filter(lambda note: title == note.title, self.data)) 
-        if notes:
-            return self.data.pop(self.data.index(notes[0]))
+        if self.in_transaction:
+            note = self[title]
+            if note:
+                self._stage(title, None, detached=True)
+                self._stage_op("delete_note", title)
+            return note
+        note = self.__remove(title)
+        if note:
+            self._journal("delete_note", title)
+        return note
+
+    def __remove(self, title: str) -> Note:
+        if not self.__indexed:
+            note = self.data.pop_title(title)
+            if note:
+                note.unsubscribe(self._on_note_change)
+                if self.__tag_stats is not None:
+                    self.__tag_stats.remove(title, note.tags)
+            return note
+        note = self.__titles.pop(title, None)
+        if not note:
+            return None
+        note.unsubscribe(self._on_note_change)
+        self.__tag_stats.remove(title, note.tags)
+        self.__order.remove(title)
+        self.__tags.remove(note, note.tags)
+        if self.__fulltext is not None:
+            self.__fulltext.remove(note)
+        # swap the last note into the freed slot instead of shifting the list
+        idx = self.__positions.pop(title)
+        last = self.data.pop()
+        if last is not note:
+            self.data[idx] = last
+            self.__positions[last.title] = idx
+        return note
     
-    def search_notes(self, query:str): # "buy #car #birthday John john"
+    def search_notes(self, query:str, titles: list = None): # "buy #car #birthday John john"
+        # titles found earlier, such as a cached result, are looked up again; notes deleted since are skipped
+        titles = self.__matching(query) if titles is None else titles
+        lookup = self.__titles.get if self.__indexed else self.__getitem__
+        return self.iterator(notes=filter(None, map(lookup, titles)))
+
+    def matching_titles(self, query: str):
+        return self.__matching(query)
+
+    def __matching(self, query: str):
         tags = set(re.findall(r"#\w+", query))        
         terms = set(query.split()) - tags     
         tags = set([tag.removeprefix("#") for tag in tags])
-        notes = self.data
-        all_queried_notes = []
-        all_tagged_notes = []
-        if terms:
-            for term in terms:
-                all_queried_notes += list(filter(lambda note: term.lower() in note.title.lower() or term.lower() in note.text.lower(), notes))
-            notes = list(set(all_queried_notes))
+        if not self.__indexed:
+            return self.storage.search_notes([term.lower() for term in terms], [tag.lower() for tag in tags])
+        ranked = [note for note, _ in self.__fulltext_index().search(terms)] if terms else None
+        notes = ranked if terms else self.notes()
         if tags:            
-            for tag in tags:                
-                tagged_notes = list(filter(lambda note: tag.lower() in note.tags.keys(), notes))
-                tagged_notes.sort(key=lambda note: note.tags[tag.lower()], reverse= True)
-                all_tagged_notes += tagged_notes
-            notes = all_tagged_notes        
-        return self.iterator(notes=notes)
+            notes = chain.from_iterable(self.__tagged(tag.lower(), ranked) for tag in tags)
+        return (note.title for note in self.__live(notes))
+
+    def tag_stats(self) -> TagStats:
+        stats = self.__tag_stats
+        if stats is None:
+            stats = TagStats()
+            for note in self.notes():
+                stats.add(note.title, note.tags)
+            self.__tag_stats = stats
+        return stats
+
+    def refresh(self) -> bool:
+        refreshed = super().refresh()
+        if refreshed and not self.__indexed:
+            # a lazy storage reloads rows rather than replaying the changes the analytics follow
+            self.__tag_stats = None
+        return refreshed
+
+    def __tagged(self, tag: str, ranked: list):
+        if ranked is None:
+            return self.__tags.ordered(tag)
+        counts = self.__tags.counts(tag)
+        return sorted((note for note in ranked if note in counts), key=lambda note: counts[note], reverse=True)
+
+    def __live(self, notes):
+        # results are computed up front; skip notes deleted or replaced while paging
+        return filter(lambda note: self.__titles.get(note.title) is note, notes)
+
+    def notes(self, page_size=256):
+        if not self.__indexed:
+            yield from self.data.scan(page_size)
+            return
+        for title in self.__order.scan():
+            note = self.__titles.get(title)
+            if note:
+                yield note
     
     def __getitem__(self, index):
         if isinstance(index, int):
             return super().__getitem__(index)
-        
-        notes = list(filter(lambda note: index == note.title, self.data)) 
-        if notes:
-            return notes[0]
+        if self.in_transaction:
+            return self._staged(index, self.__stored)
+        return self.__stored(index)
+
+    def __stored(self, title: str) -> Note:
+        if not self.__indexed:
+            return self.data.get(title)
+        return self.__titles.get(title)
     
-    def iterator(self, n=2, notes: list = None):
-        counter = 0
-        values = notes or self.data
-        while counter < len(values):
-            yield list(map(lambda note: str(note), values[counter: counter + n]))
-            counter += n
+    def iterator(self, n=None, notes = None):
+        n = n or self.page_size
+        values = iter(notes if notes is not None else self.notes(n))
+        while page := list(islice(values, n)):
+            yield list(map(lambda note: str(note), page))
 
 # notes = Notes()
 # notes.add_note(Note("test", "My #name is Paul #name. I'm a #solution #architect"))
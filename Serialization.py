@@ -1,36 +1,726 @@
+import gc
+import os
 import pickle
+import threading
+import time
 import traceback
+from abc import ABC, abstractmethod
+from contextlib import ExitStack, contextmanager, nullcontext
+from contextvars import ContextVar
 from pathlib import Path
 from typing import Dict
+from Locks import FileLock
+
+
+class PickleStorage:
+    shared = False
+    # a save pickles the whole store, too slow to capture in the background while commands wait
+    incremental = False
 
-class Serializable:
+    def __init__(self, file_name) -> None:
+        self.file_name = file_name
+
+    def load(self, obj):
+        if Path(self.file_name).exists():
+            with open(self.file_name, "rb") as file:
+                obj._set_state(pickle.load(file))
+        else:
+            obj._set_state(obj.data)
+
+    def save(self, obj):
+        self.write(self.capture(obj))
+
+    def capture(self, obj):
+        # the part of a save that needs a consistent view of obj; write() then runs without it
+        return pickle.dumps(obj._get_state())
+
+    def write(self, payload):
+        temp_name = f"{self.file_name}.tmp"
+        with open(temp_name, "wb") as file:
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_name, self.file_name)
+
+    def append(self, obj, op, args):
+        ...
+
+    def compact(self, obj):
+        self.save(obj)
+
+    def close(self):
+        ...
+
+    def locked(self):
+        return nullcontext()
+
+    def has_changes(self) -> bool:
+        return False
+
+    def refresh(self, obj) -> bool:
+        return False
+
+    def files(self) -> list:
+        return [self.file_name]
+
+    def size(self) -> int:
+        return sum(Path(name).stat().st_size for name in self.files() if Path(name).exists())
+
+
+def read_snapshot(file_name: str, obj) -> int:
+    if not Path(file_name).exists():
+        obj._set_state(obj.data)
+        return 0
+    with open(file_name, "rb") as file:
+        obj._set_state(pickle.load(file))
+        try:
+            return pickle.load(file)
+        except EOFError:
+            return 0
+
+
+class JournalStorage(PickleStorage):
+    incremental = True
+
+    def __init__(self, file_name, compact_every=10000) -> None:
+        super().__init__(file_name)
+        self.journal_name = f"{file_name}.journal"
+        self.compact_every = compact_every
+        self.__seq = 0
+        self.__pending = 0
+        self.__journal = None
+        self.__tail = None
+        self.__lock = FileLock(f"{file_name}.lock")
+        self.__compaction: threading.Thread = None
+
+    def locked(self):
+        return self.__lock.hold() if self.shared else nullcontext()
+
+    def load(self, obj):
+        with self.locked():
+            self.__load(obj)
+
+    def __load(self, obj):
+        self.__seq = read_snapshot(self.file_name, obj)
+        for journal_name in (f"{self.journal_name}.old", self.journal_name):
+            valid_size = self.__replay_journal(obj, journal_name)
+            if valid_size is not None:
+                # drop a torn tail left by a crash so new entries stay readable
+                os.truncate(journal_name, valid_size)
+        self.__open_journal()
+
+    def __open_journal(self):
+        self.__journal = open(self.journal_name, "ab")
+        if self.shared:
+            # a second handle follows what other processes append after this point
+            self.__tail = open(self.journal_name, "rb")
+            self.__tail.seek(0, os.SEEK_END)
+
+    def __close_journal(self):
+        for file in (self.__journal, self.__tail):
+            if file:
+                file.close()
+        self.__journal = self.__tail = None
+
+    def __replay_journal(self, obj, journal_name) -> int:
+        if not Path(journal_name).exists():
+            return None
+        valid_size = 0
+        with open(journal_name, "rb") as file:
+            while True:
+                try:
+                    seq, op, args = pickle.load(file)
+                except Exception:
+                    return valid_size
+                valid_size = file.tell()
+                if seq > self.__seq:
+                    obj._replay(op, args)
+                    self.__seq = seq
+                    self.__pending += 1
+
+    def append(self, obj, op, args):
+        # shared writers hold locked(), which has replayed every entry before theirs, so seq stays unique
+        self.__seq += 1
+        pickle.dump((self.__seq, op, args), self.__journal)
+        self.__journal.flush()
+        if self.__tail:
+            self.__tail.seek(self.__journal.tell())
+        self.__pending += 1
+        if self.__pending < self.compact_every:
+            return
+        if self.shared:
+            self.compact(obj)
+        else:
+            self.__compact_in_background(obj)
+
+    def compact(self, obj):
+        with self.locked():
+            self.wait()
+            snapshot = pickle.dumps(obj._get_state())
+            seq = self.__seq
+            self.__rotate()
+            if self.shared:
+                # another process could rotate the journal again before a background write ends
+                self.__write_snapshot(snapshot, seq)
+                return
+            self.__compaction = threading.Thread(target=self.__write_snapshot, args=(snapshot, seq), daemon=True)
+            self.__compaction.start()
+
+    def __rotate(self):
+        self.__close_journal()
+        if Path(self.journal_name).exists():
+            os.replace(self.journal_name, f"{self.journal_name}.old")
+        self.__open_journal()
+        self.__pending = 0
+
+    def __compact_in_background(self, obj):
+        # the live store is never read here: the previous snapshot and the rotated journal are
+        # folded into a blank copy on the compaction thread, so no write waits for the pickling
+        if self.__compaction and self.__compaction.is_alive():
+            return
+        self.wait()
+        if Path(f"{self.journal_name}.old").exists():
+            # an earlier fold failed; its entries are only safe in a snapshot of the live store
+            self.compact(obj)
+            return
+        seq = self.__seq
+        self.__rotate()
+        self.__compaction = threading.Thread(target=self.__fold, args=(obj._blank(), seq), daemon=True)
+        self.__compaction.start()
+
+    def __fold(self, blank, seq: int):
+        # the copy only grows until it is written, so full collections triggered by it would
+        # just walk the live store too, pausing every thread
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            blank.use_storage(JournalFold, journal_name=f"{self.journal_name}.old", seq=seq).deserialize()
+            snapshot = pickle.dumps(blank._get_state())
+        finally:
+            if collecting:
+                gc.enable()
+        self.__write_snapshot(snapshot, seq)
+
+    def has_changes(self) -> bool:
+        if not self.__tail:
+            return False
+        return os.fstat(self.__tail.fileno()).st_size > self.__tail.tell() or self.__rotated()
+
+    def __rotated(self) -> bool:
+        try:
+            return os.stat(self.journal_name).st_ino != os.fstat(self.__tail.fileno()).st_ino
+        except FileNotFoundError:
+            # another process is between renaming the journal and opening a new one
+            return False
+
+    def refresh(self, obj) -> bool:
+        if not self.__tail:
+            return False
+        applied = self.__follow(obj)
+        if applied is not None and self.__rotated():
+            # the old journal is complete once rotated; continue at the start of the new one
+            self.__close_journal()
+            self.__open_journal()
+            self.__tail.seek(0)
+            applied = self.__follow(obj) or None
+        if applied is None:
+            # entries are missing, or an empty new journal cannot show what a compaction folded into the snapshot
+            self.__reload(obj)
+            return True
+        return applied > 0
+
+    def __follow(self, obj) -> int:
+        applied = 0
+        while True:
+            start = self.__tail.tell()
+            try:
+                seq, op, args = pickle.load(self.__tail)
+            except Exception:
+                # a torn entry is still being written by its process
+                self.__tail.seek(start)
+                return applied
+            if seq <= self.__seq:
+                continue
+            if seq != self.__seq + 1:
+                return None
+            obj._replay(op, args)
+            self.__seq = seq
+            self.__pending += 1
+            applied += 1
+
+    def __reload(self, obj):
+        with self.locked():
+            self.__close_journal()
+            self.__seq = self.__pending = 0
+            obj._set_state(type(obj.data)())
+            self.__load(obj)
+
+    def __write_snapshot(self, snapshot: bytes, seq: int):
+        temp_name = f"{self.file_name}.tmp"
+        with open(temp_name, "wb") as file:
+            file.write(snapshot)
+            pickle.dump(seq, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_name, self.file_name)
+        Path(f"{self.journal_name}.old").unlink(missing_ok=True)
+
+    def wait(self):
+        if self.__compaction:
+            self.__compaction.join()
+            self.__compaction = None
+
+    def capture(self, obj):
+        # entries are already in the file; only the fsync is left, done on a duplicate descriptor
+        # so a compaction swapping the journal cannot close it underneath
+        self.__journal.flush()
+        return os.dup(self.__journal.fileno())
+
+    def write(self, payload):
+        try:
+            os.fsync(payload)
+        finally:
+            os.close(payload)
+
+    def close(self):
+        self.wait()
+        self.__close_journal()
+        self.__lock.close()
+
+    def files(self) -> list:
+        return [self.file_name, f"{self.journal_name}.old", self.journal_name]
+
+
+class JournalFold(PickleStorage):
+    def __init__(self, file_name, journal_name: str, seq: int) -> None:
+        super().__init__(file_name)
+        self.journal_name = journal_name
+        self.seq = seq
+
+    def load(self, obj):
+        snapshot_seq = read_snapshot(self.file_name, obj)
+        with open(self.journal_name, "rb") as file:
+            while True:
+                try:
+                    seq, op, args = pickle.load(file)
+                except EOFError:
+                    return
+                if snapshot_seq < seq <= self.seq:
+                    obj._replay(op, args)
+
+
+class TransactionError(Exception):
+    ...
+
+
+class WriteSet:
+    # one transaction level: per key the staged value (None once deleted), whether the stored
+    # value was dropped on the way and whether an op still refers to it, plus the ops to journal
+    def __init__(self, version: int) -> None:
+        self.version = version
+        self.staged = {}
+        self.moved = set()
+        self.ops = []
+
+    def stage(self, key, value, detached: bool, shared: bool, moved: bool) -> None:
+        if moved:
+            self.staged.pop(key, None)
+            self.moved.add(key)
+        self.staged[key] = (value, detached, shared)
+
+    def merge(self, write_set: "WriteSet") -> None:
+        for key, entry in write_set.staged.items():
+            self.stage(key, *entry, key in write_set.moved)
+        self.ops.extend(write_set.ops)
+
+
+STORAGES = {
+    "pickle": PickleStorage,
+    "journal": JournalStorage,
+}
+
+
+class Serializable(ABC):
     def __init__(self, file_name) -> None:
         self.__file_name = file_name
-    
+        self.__storage = PickleStorage(file_name)
+        self.__replaying = False
+        self.__generation = 0
+        self.__saved_generation = 0
+        self.__saving = threading.Lock()
+        self.__watchers = []
+        # changes made here or replayed from other processes; a transaction commits only if it did not move
+        self.__version = 0
+        # open transactions belong to the session (context) that began them
+        self.__write_sets = ContextVar(f"write_sets_{id(self)}", default=())
+
+    @property
+    def file_name(self):
+        return self.__file_name
+
+    @property
+    def storage(self):
+        return self.__storage
+
+    @classmethod
+    def storage_class(cls, kind: str) -> type:
+        return STORAGES[kind]
+
+    def use_storage(self, storage_cls, **options):
+        self.__storage = storage_cls(self.__file_name, **options)
+        return self
+
     def deserialize(self):
-        if Path(self.__file_name).exists():
-            with open(self.__file_name, "rb") as file:
-                self.data = pickle.load(file)
+        self.__replaying = True
+        try:
+            self.__storage.load(self)
+        finally:
+            self.__replaying = False
+        self.__version += 1
         return self
-    
-    def serialize(self):                
-        with open(self.__file_name, "wb") as file:
-            pickle.dump(self.data, file)              
+
+    @property
+    def dirty(self) -> bool:
+        return self.__generation != self.__saved_generation
+
+    @property
+    def version(self) -> int:
+        return self.__version
+
+    def watch(self, listener) -> None:
+        self.__watchers.append(listener)
+
+    def serialize(self, lock=nullcontext) -> bool:
+        with self.__saving:
+            with lock():
+                generation = self.__generation
+                if generation == self.__saved_generation:
+                    return False
+                payload = self.__storage.capture(self)
+            self.__storage.write(payload)
+            self.__saved_generation = generation
+            return True
+
+    def compact(self):
+        with self.locked():
+            self.__storage.compact(self)
+
+    def close(self):
+        self.__storage.close()
+
+    def has_changes(self) -> bool:
+        return self.__storage.has_changes()
+
+    def refresh(self) -> bool:
+        # changes made by other processes are replayed, not journaled again
+        self.__replaying = True
+        try:
+            refreshed = self.__storage.refresh(self)
+        finally:
+            self.__replaying = False
+        if refreshed:
+            self.__version += 1
+        return refreshed
+
+    @contextmanager
+    def locked(self):
+        with self.__storage.locked():
+            self.refresh()
+            yield
+
+    @property
+    def _replaying(self) -> bool:
+        return self.__replaying
+
+    @property
+    def in_transaction(self) -> bool:
+        return not self.__replaying and bool(self.__write_sets.get())
+
+    def begin(self) -> None:
+        # a transaction begun inside another one is a savepoint merged into it on commit
+        self.__write_sets.set(self.__write_sets.get() + (WriteSet(self.__version),))
+
+    def has_conflict(self) -> bool:
+        write_sets = self.__write_sets.get()
+        return bool(write_sets) and write_sets[0].version != self.__version
+
+    def commit(self) -> int:
+        write_set = self.__pop_write_set()
+        if self.__write_sets.get():
+            self.__write_sets.get()[-1].merge(write_set)
+            return len(write_set.ops)
+        if write_set.version != self.__version:
+            raise TransactionError("The data was changed since the transaction began.")
+        if write_set.ops:
+            self._validate(write_set.staged)
+            # every staged value is indexed once, and all ops reach the storage as one entry
+            self._apply(write_set.staged)
+            op, args = write_set.ops[0] if len(write_set.ops) == 1 else ("batch", (write_set.ops,))
+            self._journal(op, *args)
+        return len(write_set.ops)
+
+    def rollback(self) -> int:
+        return len(self.__pop_write_set().ops)
+
+    def __pop_write_set(self) -> WriteSet:
+        write_sets = self.__write_sets.get()
+        if not write_sets:
+            raise TransactionError("No transaction is open.")
+        self.__write_sets.set(write_sets[:-1])
+        return write_sets[-1]
+
+    @contextmanager
+    def transaction(self):
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def _staged(self, key, load):
+        # the first lookup on a level stages a copy, so changes stay off the stored value until commit;
+        # a value an op refers to is copied as well, so the op keeps the state it was staged with
+        write_sets = self.__write_sets.get()
+        for write_set in reversed(write_sets):
+            entry = write_set.staged.get(key)
+            if entry is not None:
+                break
+        else:
+            write_set, entry = None, (load(key), False, True)
+        value, detached, shared = entry
+        if value is None or (write_set is write_sets[-1] and not shared):
+            return value
+        value = self._copy(value)
+        write_sets[-1].stage(key, value, detached, False, False)
+        return value
+
+    def _visible(self, key, load):
+        # what the open transaction sees, without staging a copy
+        for write_set in reversed(self.__write_sets.get()):
+            entry = write_set.staged.get(key)
+            if entry is not None:
+                return entry[0]
+        return load(key)
+
+    def _staged_keys(self) -> set:
+        return {key for write_set in self.__write_sets.get() for key in write_set.staged}
+
+    def _stage(self, key, value, detached=False) -> None:
+        staged = None
+        for write_set in reversed(self.__write_sets.get()):
+            if key in write_set.staged:
+                staged, staged_detached, _ = write_set.staged[key]
+                # a key the store dropped on the way stays detached, whatever is staged after
+                detached = detached or staged_detached
+                break
+        # a value staged over a present one keeps its place; one that appears is applied after earlier ones
+        self.__write_sets.get()[-1].stage(key, value, detached, True, staged is None)
+
+    def _stage_op(self, op, *args) -> None:
+        self.__write_sets.get()[-1].ops.append((op, args))
+
+    @abstractmethod
+    def _copy(self, value):
+        ...
+
+    @abstractmethod
+    def _apply(self, staged: dict) -> None:
+        ...
+
+    def _validate(self, staged: dict) -> None:
+        ...
+
+    def _blank(self) -> "Serializable":
+        return type(self)(self.file_name)
+
+    def _get_state(self):
+        return self.data
+
+    def _set_state(self, data):
+        self.data = data
+
+    def _journal(self, op, *args):
+        self.__version += 1
+        if not self.__replaying:
+            self.__generation += 1
+            self.__storage.append(self, op, args)
+            for listener in self.__watchers:
+                listener()
+
+    def _replay(self, op, args):
+        if op == "batch":
+            for entry_op, entry_args in args[0]:
+                self._replay(entry_op, entry_args)
+            return
+        getattr(self, op)(*args)
 
 
 class SerializationContext:
-    def __init__(self,*objects) -> None:
+    def __init__(self,*objects, storage="pickle", metrics=None, shared=False, lazy=False, **options) -> None:
         self.__objects: Dict[str,Serializable] = {type(obj):obj for obj in objects}
+        self.__metrics = metrics
+        self.__lazy = lazy
+        self.__loading: Dict[type,LazyStore] = {}
+        for obj in objects:
+            obj.use_storage(obj.storage_class(storage), **options)
+            obj.storage.shared = shared
 
-    def __enter__(self) -> Dict[str,Serializable]:
+    def __enter__(self) -> "SerializationContext":
+        for obj_type, obj in self.__objects.items():
+            if self.__lazy:
+                self.__loading[obj_type] = LazyStore(obj, lambda obj=obj: self.__measure(obj, "load", obj.deserialize))
+            else:
+                self.__measure(obj, "load", obj.deserialize)
+        return self
+
+    def __loaded(self, wait=True) -> list:
+        # stores still loading in the background are waited for, or skipped when they cannot have changed yet
+        objects = []
+        for obj_type, obj in self.__objects.items():
+            store = self.__loading.get(obj_type)
+            if store is None or store.ready():
+                objects.append(obj)
+            elif wait:
+                objects.append(store._resolve())
+        return objects
+
+    def __measure(self, obj: Serializable, operation: str, func):
+        if not (self.__metrics and self.__metrics.enabled):
+            return func()
+        started = time.perf_counter()
+        result = func()
+        self.__metrics.storage(type(obj).__name__, operation, time.perf_counter() - started, obj.storage.size())
+        return result
+
+    def __getitem__(self, obj_type: type) -> Serializable:
+        if obj_type in self.__loading:
+            return self.__loading[obj_type]
+        return self.__objects[obj_type]
+
+    def watch(self, listener) -> None:
         for obj in self.__objects.values():
-            obj.deserialize()
-        return self.__objects
-    
-    def __exit__(self, exc_type:type, exc_val, exc_tb):                
+            obj.watch(listener)
+
+    def flush(self, lock=nullcontext):
+        for obj in self.__loaded(wait=False):
+            if obj.dirty:
+                self.__measure(obj, "save", lambda: obj.serialize(lock))
+
+    def compact(self):
+        for obj in self.__loaded():
+            self.__measure(obj, "compact", obj.compact)
+
+    def has_changes(self) -> bool:
+        return any(obj.has_changes() for obj in self.__loaded(wait=False))
+
+    def refresh(self) -> bool:
+        return any([self.__measure(obj, "refresh", obj.refresh) for obj in self.__loaded()])
+
+    @contextmanager
+    def locked(self):
+        # always locked in the same order, so two processes cannot wait on each other
+        with ExitStack() as stack:
+            for obj in self.__loaded():
+                stack.enter_context(obj.locked())
+            yield
+
+    def wait(self) -> None:
+        for store in self.__loading.values():
+            store.wait()
+
+    def __exit__(self, exc_type:type, exc_val, exc_tb):
+        self.wait()
+        self.flush()
         for obj in self.__objects.values():
-            obj.serialize()       
+            obj.close()
         if exc_type:
             tb = '\n'.join(traceback.format_tb(exc_tb))
-            print(f"Exception detected\n{exc_type.__name__}: {exc_val}\n{tb}")            
-        return True 
\ No newline at end of file
+            print(f"Exception detected\n{exc_type.__name__}: {exc_val}\n{tb}")
+        return True
+
+
+class LazyStore:
+    # stands in for a store loading on a background thread; the first use waits for the load
+    def __init__(self, obj: Serializable, load) -> None:
+        vars(self).update(_LazyStore__obj=obj, _LazyStore__error=None)
+        thread = threading.Thread(target=self.__load, args=(load,), name=f"load-{type(obj).__name__}", daemon=True)
+        vars(self)["_LazyStore__thread"] = thread
+        thread.start()
+
+    def __load(self, load) -> None:
+        try:
+            load()
+        except BaseException as error:
+            self.__error = error
+
+    def ready(self) -> bool:
+        return not self.__thread.is_alive() and self.__error is None
+
+    def wait(self) -> None:
+        self.__thread.join()
+
+    def _resolve(self) -> Serializable:
+        self.__thread.join()
+        if self.__error:
+            raise self.__error
+        return self.__obj
+
+    def __getattr__(self, name: str):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name: str, value) -> None:
+        setattr(self._resolve(), name, value)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._resolve()
+
+    def __len__(self) -> int:
+        return len(self._resolve())
+
+    def __iter__(self):
+        return iter(self._resolve())
+
+
+class Autosaver:
+    def __init__(self, context: SerializationContext, interval: float = 30.0, every: int = None, lock=nullcontext) -> None:
+        self.__context = context
+        self.__interval = interval
+        self.__every = every
+        self.__lock = lock
+        self.__changes = 0
+        self.__wake = threading.Event()
+        self.__stopped = threading.Event()
+        self.__thread: threading.Thread = None
+
+    def start(self) -> "Autosaver":
+        self.__context.watch(self.changed)
+        self.__thread = threading.Thread(target=self.__run, name="autosave", daemon=True)
+        self.__thread.start()
+        return self
+
+    def changed(self) -> None:
+        self.__changes += 1
+        if self.__every and self.__changes >= self.__every:
+            self.__wake.set()
+
+    def __run(self) -> None:
+        while not self.__stopped.is_set():
+            self.__wake.wait(self.__interval)
+            self.__wake.clear()
+            self.__changes = 0
+            try:
+                # only dirty stores are saved, and the lock is held just to capture their state
+                self.__context.flush(self.__lock)
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self) -> None:
+        self.__stopped.set()
+        self.__wake.set()
+        if self.__thread:
+            self.__thread.join()
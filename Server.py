@@ -0,0 +1,123 @@
+import asyncio
+import contextvars
+import queue
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from Console import Console
+
+PROMPT = ">>> "
+
+
+class SessionConsole(Console):
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter) -> None:
+        self.__loop = loop
+        self.__writer = writer
+        self.__lines = []
+        self.__inbox = queue.Queue()
+
+    def feed(self, line: str) -> None:
+        # None tells the session that the client has gone
+        self.__inbox.put(line)
+
+    def write(self, text: str) -> None:
+        self.__lines.append(text)
+
+    def read(self, prompt: str = PROMPT) -> str:
+        self.__send("".join(line + "\n" for line in self.__lines) + prompt)
+        self.__lines.clear()
+        line = self.__inbox.get()
+        if line is None:
+            raise EOFError
+        return line
+
+    def flush(self) -> None:
+        if self.__lines:
+            self.__send("".join(line + "\n" for line in self.__lines))
+            self.__lines.clear()
+
+    def __send(self, text: str) -> None:
+        self.__loop.call_soon_threadsafe(self.__writer.write, text.encode())
+
+
+def run_session(session, console: SessionConsole) -> None:
+    try:
+        session(console)
+    except Exception as error:
+        traceback.print_exc()
+        console.write(f"Session closed after an internal error: {error}")
+    finally:
+        console.flush()
+
+
+class BotServer:
+    def __init__(self, session, max_sessions=64) -> None:
+        self.__session = session
+        # handlers are blocking, so every session gets a worker thread; extra clients wait for a free one
+        self.__executor = ThreadPoolExecutor(max_sessions, thread_name_prefix="session")
+        self.__consoles = set()
+        self.__server: asyncio.AbstractServer = None
+
+    @property
+    def sockets(self):
+        return self.__server.sockets if self.__server else ()
+
+    async def start(self, address: str) -> "BotServer":
+        host, _, port = address.rpartition(":")
+        if port.isdigit():
+            self.__server = await asyncio.start_server(self.handle, host or None, int(port))
+        else:
+            self.__server = await asyncio.start_unix_server(self.handle, address)
+        return self
+
+    async def serve_forever(self) -> None:
+        # asyncio's own serve_forever waits for open connections on cancel, which idle sessions never close
+        try:
+            await asyncio.get_running_loop().create_future()
+        finally:
+            self.close()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        loop = asyncio.get_running_loop()
+        console = SessionConsole(loop, writer)
+        self.__consoles.add(console)
+        feeder = asyncio.create_task(self.__feed(reader, console))
+        try:
+            await loop.run_in_executor(self.__executor, contextvars.Context().run, run_session, self.__session, console)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.__consoles.discard(console)
+            feeder.cancel()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def __feed(self, reader: asyncio.StreamReader, console: SessionConsole) -> None:
+        try:
+            while line := await reader.readline():
+                console.feed(line.decode(errors="replace").rstrip("\r\n"))
+        except ConnectionError:
+            pass
+        finally:
+            console.feed(None)
+
+    def close(self) -> None:
+        if self.__server:
+            self.__server.close()
+        for console in list(self.__consoles):
+            console.feed(None)
+        # let running commands finish before the caller flushes storage
+        self.__executor.shutdown(wait=True)
+
+
+def serve(address: str, session, max_sessions=64) -> None:
+    async def run():
+        server = await BotServer(session, max_sessions).start(address)
+        print(f"Serving on {', '.join(str(sock.getsockname()) for sock in server.sockets)}")
+        await server.serve_forever()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print("Server stopped.")
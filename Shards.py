@@ -0,0 +1,187 @@
+import threading
+import zlib
+from bisect import bisect_right
+from collections.abc import MutableMapping
+from concurrent.futures.process import BrokenProcessPool
+from itertools import accumulate, chain
+from Contacts import AddressBook, Record, process_pool
+
+PARALLEL_THRESHOLD = 200_000
+
+# shards a pool worker was sent, kept between scans in the worker process
+WORKER_SHARDS = {}
+
+
+def shard_of(name: str, count: int) -> int:
+    # crc32 rather than hash(), which is salted per process, so a name lands in the same shard on every run
+    return zlib.crc32(name.encode("utf-8", "surrogatepass")) % count
+
+
+def shard_rows(records, position) -> list:
+    return [(position(record.name.value), record.name.value, *(phone.value for phone in record.phones)) for record in records]
+
+
+class ShardScan:
+    # a shard laid out as one string of lower-cased names and phones, a row per line,
+    # so a substring scan runs in str.find instead of a Python loop over records
+    def __init__(self, rows: list) -> None:
+        self.rows = [row[:2] for row in rows]
+        lines = ["\0".join((row[1].lower(), *row[2:])) for row in rows]
+        self.starts = list(accumulate((len(line) + 1 for line in lines), initial=0))
+        self.text = "\n".join(lines)
+
+    def search(self, term: str) -> list:
+        # the term holds no separator, so a match never spans two fields or rows
+        found = []
+        idx = self.text.find(term)
+        while idx != -1:
+            row = bisect_right(self.starts, idx) - 1
+            found.append(self.rows[row])
+            idx = self.text.find(term, self.starts[row + 1]) if row + 1 < len(self.rows) else -1
+        return found
+
+
+def scan_shard(shard: int, rows: list, term: str) -> list:
+    # rows come only with the first scan of a shard and after it changed
+    if rows is not None:
+        WORKER_SHARDS[shard] = ShardScan(rows)
+    return WORKER_SHARDS[shard].search(term)
+
+
+class ShardedRecords(MutableMapping):
+    def __init__(self, count=1, records=None) -> None:
+        self.shards = [{} for _ in range(count)]
+        self.versions = [0] * count
+        self.generation = 0
+        for name, record in (records or {}).items():
+            self[name] = record
+
+    def shard(self, name: str) -> dict:
+        return self.shards[shard_of(name, len(self.shards))]
+
+    def touch(self, name: str) -> None:
+        self.versions[shard_of(name, len(self.shards))] += 1
+        self.generation += 1
+
+    def __getitem__(self, name: str) -> Record:
+        return self.shard(name)[name]
+
+    def get(self, name: str, default=None) -> Record:
+        return self.shard(name).get(name, default)
+
+    def __contains__(self, name) -> bool:
+        return name in self.shard(name)
+
+    def __setitem__(self, name: str, record: Record) -> None:
+        idx = shard_of(name, len(self.shards))
+        self.shards[idx][name] = record
+        self.versions[idx] += 1
+        self.generation += 1
+
+    def __delitem__(self, name: str) -> None:
+        idx = shard_of(name, len(self.shards))
+        del self.shards[idx][name]
+        self.versions[idx] += 1
+        self.generation += 1
+
+    def __len__(self) -> int:
+        return sum(map(len, self.shards))
+
+    def __iter__(self):
+        for shard in self.shards:
+            yield from shard
+
+
+class ShardedAddressBook(AddressBook):
+    # records are partitioned by name hash, so a lookup touches one shard; scans the
+    # trigram index cannot narrow run per shard, across worker processes on big books
+    def __init__(self, file_name, shards=4, workers: int = None, parallel_threshold=PARALLEL_THRESHOLD) -> None:
+        self.__count = shards
+        self.__workers = workers if workers is not None else shards
+        self.__parallel_threshold = parallel_threshold
+        self.__pools = None
+        self.__sent = [None] * shards
+        self.__scans = [(None, None)] * shards
+        self.__scan_lock = threading.Lock()
+        super().__init__(file_name)
+        self.data = ShardedRecords(shards)
+
+    def _get_state(self):
+        if getattr(self.data, "lazy", False):
+            return self.data
+        # saved as one dict in contact order, the same file an unsharded book reads
+        return {record.name.value: record for record in self.records()}
+
+    def _set_state(self, data) -> None:
+        if isinstance(data, ShardedRecords):
+            data = {name: record for shard in data.shards for name, record in shard.items()}
+        # the indexes are built from the plain dict so contact order follows the stored order
+        super()._set_state(data)
+        if not getattr(data, "lazy", False):
+            self.data = ShardedRecords(self.__count, data)
+            self.__sent = [None] * self.__count
+            self.__scans = [(None, None)] * self.__count
+
+    def _on_record_change(self, record: Record, event: str, *args) -> None:
+        super()._on_record_change(record, event, *args)
+        if event != "claim_phone" and isinstance(self.data, ShardedRecords):
+            self.data.touch(record.name.value)
+
+    def export_records(self):
+        yield from self.records()
+
+    def _scan_contacts(self, term: str):
+        if not isinstance(self.data, ShardedRecords) or "\0" in term or "\n" in term:
+            yield from super()._scan_contacts(term)
+            return
+        with self.__scan_lock:
+            found = self.__scan_parallel(term) if self.__parallel() else self.__scan_local(term)
+            generation = self.data.generation
+        # each shard answers in contact order, and sorting those runs by position merges them
+        for _, name in sorted(chain.from_iterable(found)):
+            contact = self.data.get(name)
+            # contacts are only checked again once the book changed since the scan
+            if contact and (self.data.generation == generation or contact.is_matching(term)):
+                yield contact
+
+    def __parallel(self) -> bool:
+        # worker processes only pay for their start-up and the shard transfers on big books
+        return self.__workers > 1 and len(self.data) >= self.__parallel_threshold
+
+    def __scan_local(self, term: str) -> list:
+        found = []
+        for idx, shard in enumerate(self.data.shards):
+            version, scan = self.__scans[idx]
+            if version != self.data.versions[idx]:
+                scan = ShardScan(shard_rows(shard.values(), self._position))
+                self.__scans[idx] = (self.data.versions[idx], scan)
+            found.append(scan.search(term))
+        return found
+
+    def __scan_parallel(self, term: str) -> list:
+        if self.__pools is None:
+            self.__pools = [process_pool(1) for _ in range(min(self.__workers, self.__count))]
+        versions = list(self.data.versions)
+        futures = []
+        for idx, shard in enumerate(self.data.shards):
+            rows = shard_rows(shard.values(), self._position) if self.__sent[idx] != versions[idx] else None
+            futures.append(self.__pools[idx % len(self.__pools)].submit(scan_shard, idx, rows, term))
+        try:
+            found = [future.result() for future in futures]
+        except BrokenProcessPool:
+            # a lost worker lost its shards too; they are sent again to fresh workers next time
+            self.__shutdown()
+            return self.__scan_local(term)
+        self.__sent = versions
+        return found
+
+    def __shutdown(self) -> None:
+        if self.__pools:
+            for pool in self.__pools:
+                pool.shutdown(cancel_futures=True)
+        self.__pools = None
+        self.__sent = [None] * self.__count
+
+    def close(self):
+        self.__shutdown()
+        super().close()
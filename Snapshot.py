@@ -0,0 +1,384 @@
+import json
+import mmap
+import os
+import struct
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from datetime import date
+from itertools import accumulate
+from pathlib import Path
+from Serialization import PickleStorage
+from Contacts import AddressBook, Record, Phone, Birthday
+from Indexes import next_birthday
+from Notes import Notes, Note
+from SqlStorage import SqlRecords, SqlNotes
+
+MAGIC = b"BOTSNAP1"
+HEADER = struct.Struct("<8sQ")
+
+
+def snapshot_name(file_name: str) -> str:
+    return str(Path(file_name).with_suffix(".snap"))
+
+
+class SnapshotWriter:
+    def __init__(self) -> None:
+        self.__columns = {}
+
+    def ints(self, name: str, values) -> None:
+        self.__columns[name] = array("q", values).tobytes()
+
+    def strings(self, name: str, values) -> None:
+        # every value ends with a NUL, so a substring search over the whole blob never spans two values
+        offsets = array("q", [0])
+        blob = bytearray()
+        for value in values:
+            blob += value.encode()
+            blob += b"\0"
+            offsets.append(len(blob))
+        self.__columns[name] = bytes(blob)
+        self.__columns[f"{name}.offsets"] = offsets.tobytes()
+
+    def write(self, path: str, meta: dict = None) -> None:
+        layout, position = {}, 0
+        for name, data in self.__columns.items():
+            layout[name] = [position, len(data)]
+            position += len(data) + -len(data) % 8
+        header = json.dumps({"meta": meta or {}, "columns": layout}).encode()
+        header += b" " * (-(HEADER.size + len(header)) % 8)
+        temp_name = f"{path}.tmp"
+        with open(temp_name, "wb") as file:
+            file.write(HEADER.pack(MAGIC, len(header)))
+            file.write(header)
+            for data in self.__columns.values():
+                file.write(data)
+                file.write(b"\0" * (-len(data) % 8))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_name, path)
+
+
+class StringColumn:
+    def __init__(self, data: mmap.mmap, start: int, offsets: memoryview) -> None:
+        self.__data = data
+        self.__start = start
+        self.__offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.__offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        return self.__data[self.__start + self.__offsets[idx]:self.__start + self.__offsets[idx + 1] - 1].decode()
+
+    def find_all(self, term: str):
+        # mmap.find scans the mapped pages in C; each hit is mapped back to its value by the offsets
+        needle = term.encode()
+        if not needle:
+            yield from range(len(self))
+            return
+        position, end = self.__start, self.__start + self.__offsets[len(self)]
+        while (found := self.__data.find(needle, position, end)) != -1:
+            idx = bisect_right(self.__offsets, found - self.__start) - 1
+            yield idx
+            position = self.__start + self.__offsets[idx + 1]
+
+
+class SnapshotReader:
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as file:
+            self.__map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.inode = os.fstat(file.fileno()).st_ino
+        magic, size = HEADER.unpack_from(self.__map)
+        if magic != MAGIC:
+            self.__map.close()
+            raise ValueError(f"'{path}' is not a snapshot file.")
+        header = json.loads(self.__map[HEADER.size:HEADER.size + size])
+        self.meta = header["meta"]
+        self.__base = HEADER.size + size
+        self.__columns = header["columns"]
+        self.__views = []
+
+    def ints(self, name: str) -> memoryview:
+        start, length = self.__columns[name]
+        view = memoryview(self.__map)[self.__base + start:self.__base + start + length].cast("q")
+        # the map can only be closed once every view over it is released
+        self.__views.append(view)
+        return view
+
+    def strings(self, name: str) -> StringColumn:
+        return StringColumn(self.__map, self.__base + self.__columns[name][0], self.ints(f"{name}.offsets"))
+
+    def close(self) -> None:
+        for view in self.__views:
+            view.release()
+        self.__map.close()
+
+
+def search_sorted(keys, count: int, key, value) -> int:
+    # binary search over positions whose keys are decoded from the map only on comparison
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if key(keys[middle]) < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def birthday_day(ordinal: int) -> int:
+    birthday = date.fromordinal(ordinal)
+    return birthday.month * 100 + birthday.day
+
+
+def write_book_snapshot(book: AddressBook, path: str) -> int:
+    names, phones, birthdays, phone_pairs = [], [], [], set()
+    for idx, record in enumerate(book.records()):
+        names.append(record.name.value)
+        phones.append(";".join(phone.value for phone in record.phones))
+        birthdays.append(record.birthday._get_value() if isinstance(record.birthday, Birthday) else 0)
+        phone_pairs.update((raw, idx) for raw in map(Phone._get_value, record.phones) if isinstance(raw, int))
+    phone_pairs = sorted(phone_pairs)
+    birthday_order = sorted((idx for idx, ordinal in enumerate(birthdays) if ordinal),
+                            key=lambda idx: (birthday_day(birthdays[idx]), names[idx]))
+    writer = SnapshotWriter()
+    writer.strings("names", names)
+    writer.strings("names_lower", (name.lower() for name in names))
+    writer.strings("phones", phones)
+    writer.ints("birthdays", birthdays)
+    writer.ints("name_order", sorted(range(len(names)), key=names.__getitem__))
+    writer.ints("phone_keys", (phone for phone, _ in phone_pairs))
+    writer.ints("phone_ids", (idx for _, idx in phone_pairs))
+    writer.ints("birthday_keys", (birthday_day(birthdays[idx]) for idx in birthday_order))
+    writer.ints("birthday_ids", birthday_order)
+    writer.write(path, {"kind": "contacts", "count": len(names)})
+    return len(names)
+
+
+def write_notes_snapshot(notes: Notes, path: str) -> int:
+    titles, texts, postings = [], [], {}
+    for idx, note in enumerate(notes.notes()):
+        titles.append(note.title)
+        texts.append(note.text)
+        for tag, count in note.tags.items():
+            postings.setdefault(tag, []).append((-count, idx))
+    tags = sorted(postings)
+    writer = SnapshotWriter()
+    writer.strings("titles", titles)
+    writer.strings("texts", texts)
+    writer.strings("search_text", (f"{title}\n{text}".lower() for title, text in zip(titles, texts)))
+    writer.ints("title_order", sorted(range(len(titles)), key=titles.__getitem__))
+    writer.strings("tags", tags)
+    # postings of each tag hold note positions, most occurrences first
+    tag_postings = [sorted(postings[tag]) for tag in tags]
+    writer.ints("tag_starts", accumulate(map(len, tag_postings), initial=0))
+    writer.ints("tag_notes", (idx for items in tag_postings for _, idx in items))
+    writer.write(path, {"kind": "notes", "count": len(titles)})
+    return len(titles)
+
+
+def write_snapshot(obj, path: str = None) -> int:
+    path = path or snapshot_name(obj.file_name)
+    if isinstance(obj, AddressBook):
+        return write_book_snapshot(obj, path)
+    return write_notes_snapshot(obj, path)
+
+
+class SnapshotStorage(PickleStorage, ABC):
+    read_only = True
+
+    def __init__(self, file_name, snapshot: str = None) -> None:
+        super().__init__(file_name)
+        self.snapshot = snapshot or snapshot_name(file_name)
+        self.reader: SnapshotReader = None
+
+    def load(self, obj):
+        if not Path(self.snapshot).exists():
+            raise FileNotFoundError(f"Snapshot '{self.snapshot}' not found. Write one with --write-snapshot first.")
+        self.reader = SnapshotReader(self.snapshot)
+        self.__inode = self.reader.inode
+        self.open_columns()
+        obj._set_state(self.lazy_data(obj))
+
+    def has_changes(self) -> bool:
+        # a new snapshot replaces the file atomically, so a different inode means new data
+        try:
+            return self.shared and os.stat(self.snapshot).st_ino != self.__inode
+        except FileNotFoundError:
+            return False
+
+    def refresh(self, obj) -> bool:
+        if not self.has_changes():
+            return False
+        self.close()
+        self.load(obj)
+        return True
+
+    def append(self, obj, op, args):
+        raise PermissionError(f"Snapshot '{self.snapshot}' is read-only.")
+
+    def capture(self, obj):
+        ...
+
+    def write(self, payload):
+        ...
+
+    def compact(self, obj):
+        ...
+
+    def close(self):
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+
+    def files(self) -> list:
+        return [self.snapshot]
+
+    @abstractmethod
+    def open_columns(self) -> None:
+        ...
+
+    @abstractmethod
+    def lazy_data(self, obj):
+        ...
+
+
+class AddressBookSnapshotStorage(SnapshotStorage):
+    def open_columns(self) -> None:
+        self.__names = self.reader.strings("names")
+        self.__names_lower = self.reader.strings("names_lower")
+        self.__phones = self.reader.strings("phones")
+        self.__birthdays = self.reader.ints("birthdays")
+        self.__name_order = self.reader.ints("name_order")
+        self.__phone_keys = self.reader.ints("phone_keys")
+        self.__phone_ids = self.reader.ints("phone_ids")
+        self.__birthday_keys = self.reader.ints("birthday_keys")
+        self.__birthday_ids = self.reader.ints("birthday_ids")
+
+    def lazy_data(self, obj):
+        return SqlRecords(self, obj._attach)
+
+    def __find(self, name: str) -> int:
+        order = self.__name_order
+        found = search_sorted(order, len(order), self.__names.__getitem__, name)
+        if found < len(order) and self.__names[order[found]] == name:
+            return order[found]
+        return None
+
+    def __row(self, idx: int) -> tuple:
+        phones = self.__phones[idx]
+        return self.__names[idx], phones.split(";") if phones else [], self.__birthdays[idx] or None
+
+    def build_record(self, name: str, phones: list, birthday: int) -> Record:
+        record = Record(name)
+        record.phones = [Phone.trusted(phone) for phone in phones]
+        if birthday is not None:
+            record.birthday = Birthday._from_raw(birthday)
+        return record
+
+    def load_record(self, name: str) -> Record:
+        idx = self.__find(name)
+        return self.build_record(*self.__row(idx)) if idx is not None else None
+
+    def has_record(self, name: str) -> bool:
+        return self.__find(name) is not None
+
+    def count(self) -> int:
+        return len(self.__names)
+
+    def names(self):
+        for idx in range(len(self.__names)):
+            yield self.__names[idx]
+
+    def records(self, page_size=256):
+        for idx in range(len(self.__names)):
+            yield self.__row(idx)
+
+    def search_contacts(self, term: str) -> list:
+        found = set(self.__names_lower.find_all(term)).union(self.__phones.find_all(term))
+        return [self.__names[idx] for idx in sorted(found)]
+
+    def phone_owners(self, prefix: str) -> list:
+        if not prefix.isascii():
+            return []
+        scale = 10 ** (10 - len(prefix))
+        low = bisect_left(self.__phone_keys, int(prefix) * scale)
+        high = bisect_left(self.__phone_keys, (int(prefix) + 1) * scale)
+        return [(f"{self.__phone_keys[idx]:010d}", self.__names[self.__phone_ids[idx]]) for idx in range(low, high)]
+
+    def duplicate_phones(self) -> list:
+        keys, rows, start = self.__phone_keys, [], 0
+        for end in range(1, len(keys) + 1):
+            if end == len(keys) or keys[end] != keys[start]:
+                if end - start > 1:
+                    rows += sorted((f"{keys[start]:010d}", self.__names[self.__phone_ids[idx]]) for idx in range(start, end))
+                start = end
+        return rows
+
+    def upcoming_birthdays(self, days: int = None, today: date = None):
+        today = today or date.today()
+        start = bisect_left(self.__birthday_keys, today.month * 100 + today.day)
+        for idx in list(range(start, len(self.__birthday_ids))) + list(range(start)):
+            record_idx = self.__birthday_ids[idx]
+            birthday = date.fromordinal(self.__birthdays[record_idx])
+            birthday = next_birthday(birthday.month, birthday.day, today)
+            if days is not None and (birthday - today).days > days:
+                return
+            yield birthday, self.__names[record_idx]
+
+
+class NotesSnapshotStorage(SnapshotStorage):
+    def open_columns(self) -> None:
+        self.__titles = self.reader.strings("titles")
+        self.__texts = self.reader.strings("texts")
+        self.__search_text = self.reader.strings("search_text")
+        self.__title_order = self.reader.ints("title_order")
+        self.__tags = self.reader.strings("tags")
+        self.__tag_starts = self.reader.ints("tag_starts")
+        self.__tag_notes = self.reader.ints("tag_notes")
+
+    def lazy_data(self, obj):
+        return SqlNotes(self, obj._attach)
+
+    def load_note(self, title: str) -> Note:
+        order = self.__title_order
+        found = search_sorted(order, len(order), self.__titles.__getitem__, title)
+        if found < len(order) and self.__titles[order[found]] == title:
+            return Note(title, self.__texts[order[found]])
+        return None
+
+    def count(self) -> int:
+        return len(self.__titles)
+
+    def notes(self, offset: int = 0, limit: int = -1):
+        end = len(self.__titles) if limit < 0 else min(offset + limit, len(self.__titles))
+        for idx in range(offset, end):
+            yield self.__titles[idx], self.__texts[idx]
+
+    def all_notes(self, page_size=256):
+        yield from self.notes()
+
+    def __tagged(self, tag: str) -> list:
+        found = search_sorted(range(len(self.__tags)), len(self.__tags), self.__tags.__getitem__, tag)
+        if found == len(self.__tags) or self.__tags[found] != tag:
+            return []
+        notes = self.__tag_notes[self.__tag_starts[found]:self.__tag_starts[found + 1]]
+        return [self.__titles[idx] for idx in notes]
+
+    def search_notes(self, terms: list, tags: list) -> list:
+        titles = None
+        if terms:
+            hits = Counter(idx for term in terms for idx in self.__search_text.find_all(term))
+            ranked = sorted(hits, key=lambda idx: (-hits[idx], idx))
+            titles = {self.__titles[idx]: rank for rank, idx in enumerate(ranked)}
+        if not tags:
+            return list(titles or [])
+        tagged = []
+        for tag in tags:
+            if titles is None:
+                tagged += self.__tagged(tag)
+            else:
+                tagged += sorted((title for title in self.__tagged(tag) if title in titles), key=titles.get)
+        return tagged
@@ -0,0 +1,466 @@
+import sqlite3
+from abc import ABC, abstractmethod
+from collections.abc import MutableMapping
+from datetime import date
+from pathlib import Path
+from Serialization import PickleStorage, JournalStorage
+from Contacts import Record, Phone, Birthday
+from Indexes import next_birthday
+from Notes import Note
+
+
+class SqliteStorage(PickleStorage, ABC):
+    SCHEMA = ""
+    incremental = True
+
+    def __init__(self, file_name, database: str = None) -> None:
+        super().__init__(file_name)
+        self.database = database or str(Path(file_name).with_suffix(".db"))
+        self.connection: sqlite3.Connection = None
+        self.__data_version = None
+
+    def connect(self) -> None:
+        self.connection = sqlite3.connect(self.database, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.create_function("pylower", 1, str.lower, deterministic=True)
+        self.connection.executescript(self.SCHEMA)
+
+    def load(self, obj):
+        self.connect()
+        legacy = JournalStorage(self.file_name)
+        if self.is_empty() and (Path(self.file_name).exists() or Path(legacy.journal_name).exists()):
+            # first start on existing pickle/journal files: copy them into the database once
+            legacy.load(obj)
+            legacy.close()
+            with self.connection:
+                self.import_state(obj._get_state())
+        self.__data_version = self.data_version()
+        obj._set_state(self.lazy_data(obj))
+
+    def data_version(self) -> int:
+        # changes only when another connection, possibly in another process, commits
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def has_changes(self) -> bool:
+        return self.shared and self.data_version() != self.__data_version
+
+    def refresh(self, obj) -> bool:
+        if not self.has_changes():
+            return False
+        self.__data_version = self.data_version()
+        obj.data.invalidate()
+        return True
+
+    def append(self, obj, op, args):
+        with self.connection:
+            getattr(self, f"op_{op}")(*args)
+
+    def op_batch(self, entries: list) -> None:
+        # a committed transaction arrives as one entry and lands in one SQLite transaction
+        for op, args in entries:
+            getattr(self, f"op_{op}")(*args)
+
+    def capture(self, obj):
+        self.connection.commit()
+
+    def write(self, payload):
+        ...
+
+    def compact(self, obj):
+        self.connection.commit()
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def files(self) -> list:
+        return [self.database, f"{self.database}-wal"]
+
+    def next_position(self, table: str) -> int:
+        return self.connection.execute(f"SELECT COALESCE(MAX(position), 0) + 1 FROM {table}").fetchone()[0]
+
+    def paged(self, query: str, page_size=256):
+        # keyset pagination: each page restarts after the last position seen, so no
+        # statement stays open between pages and concurrent writes cannot disturb the walk
+        position = 0
+        while True:
+            rows = self.connection.execute(query, (position, page_size)).fetchall()
+            for position, *row in rows:
+                yield row
+            if len(rows) < page_size:
+                return
+
+    @abstractmethod
+    def is_empty(self) -> bool:
+        ...
+
+    @abstractmethod
+    def import_state(self, data) -> None:
+        ...
+
+    @abstractmethod
+    def lazy_data(self, obj):
+        ...
+
+
+class AddressBookSqlStorage(SqliteStorage):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS records (
+            name TEXT PRIMARY KEY,
+            name_lower TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            birthday INTEGER,
+            birthday_day INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS records_position ON records(position);
+        CREATE INDEX IF NOT EXISTS records_birthday_day ON records(birthday_day, name);
+        CREATE TABLE IF NOT EXISTS phones (
+            name TEXT NOT NULL REFERENCES records(name) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            phone TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS phones_name ON phones(name, position);
+        CREATE INDEX IF NOT EXISTS phones_phone ON phones(phone);
+    """
+
+    def is_empty(self) -> bool:
+        return self.connection.execute("SELECT 1 FROM records LIMIT 1").fetchone() is None
+
+    def import_state(self, data) -> None:
+        self.op_add_records(list(data.values()))
+
+    def lazy_data(self, obj):
+        return SqlRecords(self, obj._attach)
+
+    def __birthday_columns(self, record: Record) -> tuple:
+        if not isinstance(record.birthday, Birthday):
+            return None, None
+        birthday = record.birthday.date
+        # month * 100 + day orders like the day of year and keeps Feb 29 stable
+        return birthday.toordinal(), birthday.month * 100 + birthday.day
+
+    def op_add_record(self, record: Record) -> None:
+        self.op_add_records([record])
+
+    def op_add_records(self, records: list) -> None:
+        position = self.next_position("records")
+        for record in records:
+            name = record.name.value
+            ordinal, day = self.__birthday_columns(record)
+            updated = self.connection.execute(
+                "UPDATE records SET birthday = ?, birthday_day = ? WHERE name = ?", (ordinal, day, name)).rowcount
+            if updated:
+                self.connection.execute("DELETE FROM phones WHERE name = ?", (name,))
+            else:
+                self.connection.execute(
+                    "INSERT INTO records (name, name_lower, position, birthday, birthday_day) VALUES (?, ?, ?, ?, ?)",
+                    (name, name.lower(), position, ordinal, day))
+                position += 1
+            self.connection.executemany(
+                "INSERT INTO phones (name, position, phone) VALUES (?, ?, ?)",
+                ((name, idx, phone.value) for idx, phone in enumerate(record.phones)))
+
+    def op_delete(self, name: str) -> None:
+        self.connection.execute("DELETE FROM records WHERE name = ?", (name,))
+
+    def op_add_phone(self, name: str, phone: str) -> None:
+        position = self.connection.execute(
+            "SELECT COALESCE(MAX(position), -1) + 1 FROM phones WHERE name = ?", (name,)).fetchone()[0]
+        self.connection.execute(
+            "INSERT INTO phones (name, position, phone) VALUES (?, ?, ?)", (name, position, Phone(phone).value))
+
+    def op_edit_phone(self, name: str, old_phone: str, new_phone: str) -> None:
+        self.connection.execute(
+            "UPDATE phones SET phone = ? WHERE name = ? AND phone = ?", (Phone(new_phone).value, name, old_phone))
+
+    def op_remove_phone(self, name: str, phone: str) -> None:
+        self.connection.execute("DELETE FROM phones WHERE name = ? AND phone = ?", (name, phone))
+
+    def op_add_birthday(self, name: str, birthday: str) -> None:
+        birthday = Birthday(birthday).date
+        self.connection.execute(
+            "UPDATE records SET birthday = ?, birthday_day = ? WHERE name = ?",
+            (birthday.toordinal(), birthday.month * 100 + birthday.day, name))
+
+    def build_record(self, name: str, phones: list, birthday: int) -> Record:
+        record = Record.__new__(Record)
+        record.__setstate__((name, (), birthday))
+        record.phones = [Phone.trusted(phone) for phone in phones]
+        return record
+
+    def load_record(self, name: str) -> Record:
+        row = self.connection.execute("SELECT birthday FROM records WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        phones = [phone for phone, in self.connection.execute(
+            "SELECT phone FROM phones WHERE name = ? ORDER BY position", (name,))]
+        return self.build_record(name, phones, row[0])
+
+    def has_record(self, name: str) -> bool:
+        return self.connection.execute("SELECT 1 FROM records WHERE name = ?", (name,)).fetchone() is not None
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def names(self):
+        for name, in self.paged("SELECT position, name FROM records WHERE position > ? ORDER BY position LIMIT ?"):
+            yield name
+
+    def records(self, page_size=256):
+        rows = self.paged("""
+            SELECT position, name, birthday,
+                   (SELECT group_concat(phone, ';') FROM
+                       (SELECT phone FROM phones WHERE phones.name = records.name ORDER BY position))
+            FROM records WHERE position > ? ORDER BY position LIMIT ?""", page_size)
+        for name, birthday, phones in rows:
+            yield name, phones.split(";") if phones else [], birthday
+
+    def search_contacts(self, term: str) -> list:
+        rows = self.connection.execute("""
+            SELECT name FROM records
+            WHERE instr(name_lower, :term)
+               OR EXISTS (SELECT 1 FROM phones WHERE phones.name = records.name AND instr(phone, :term))
+            ORDER BY position""", {"term": term})
+        return [name for name, in rows]
+
+    def phone_owners(self, prefix: str) -> list:
+        # a prefix is the key range [prefix, prefix with its last digit bumped) on the phones index
+        high = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        rows = self.connection.execute("""
+            SELECT DISTINCT phone, phones.name FROM phones JOIN records ON records.name = phones.name
+            WHERE phone >= ? AND phone < ? ORDER BY phone, records.position""", (prefix, high))
+        return list(rows)
+
+    def duplicate_phones(self) -> list:
+        rows = self.connection.execute("""
+            SELECT DISTINCT phone, name FROM phones
+            WHERE phone IN (SELECT phone FROM phones GROUP BY phone HAVING COUNT(DISTINCT name) > 1)
+            ORDER BY phone, name""")
+        return list(rows)
+
+    def upcoming_birthdays(self, days: int = None, today: date = None):
+        today = today or date.today()
+        start = today.month * 100 + today.day
+        queries = ("SELECT name, birthday FROM records WHERE birthday_day >= ? ORDER BY birthday_day, name",
+                   "SELECT name, birthday FROM records WHERE birthday_day < ? ORDER BY birthday_day, name")
+        for query in queries:
+            for name, ordinal in self.connection.execute(query, (start,)):
+                birthday = date.fromordinal(ordinal)
+                birthday = next_birthday(birthday.month, birthday.day, today)
+                if days is not None and (birthday - today).days > days:
+                    return
+                yield birthday, name
+
+
+class SqlRecords(MutableMapping):
+    lazy = True
+
+    def __init__(self, storage: AddressBookSqlStorage, on_load) -> None:
+        self.__storage = storage
+        self.__on_load = on_load
+        self.__cache = {}
+
+    def __getitem__(self, name: str) -> Record:
+        record = self.__cache.get(name)
+        if record is None:
+            record = self.__storage.load_record(name)
+            if record is None:
+                raise KeyError(name)
+            self.__on_load(record)
+            self.__cache[name] = record
+        return record
+
+    def __setitem__(self, name: str, record: Record) -> None:
+        self.__cache[name] = record
+
+    def invalidate(self) -> None:
+        self.__cache.clear()
+
+    def __delitem__(self, name: str) -> None:
+        if name not in self:
+            raise KeyError(name)
+        self.__cache.pop(name, None)
+
+    def __contains__(self, name) -> bool:
+        return name in self.__cache or self.__storage.has_record(name)
+
+    def __len__(self) -> int:
+        return self.__storage.count()
+
+    def __iter__(self):
+        return self.__storage.names()
+
+    def values(self):
+        return self.scan()
+
+    def scan(self, page_size=256):
+        # rows are read one page at a time, so a small page sees writes made between pages
+        for name, phones, birthday in self.__storage.records(page_size):
+            record = self.__cache.get(name)
+            if record is None:
+                record = self.__storage.build_record(name, phones, birthday)
+                self.__on_load(record)
+            yield record
+
+
+class NotesSqlStorage(SqliteStorage):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS notes (
+            title TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS notes_position ON notes(position);
+        CREATE TABLE IF NOT EXISTS note_tags (
+            title TEXT NOT NULL REFERENCES notes(title) ON DELETE CASCADE,
+            tag TEXT NOT NULL,
+            count INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS note_tags_tag ON note_tags(tag, count DESC);
+        CREATE INDEX IF NOT EXISTS note_tags_title ON note_tags(title);
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(title, text, tokenize = 'trigram');
+    """
+
+    def is_empty(self) -> bool:
+        return self.connection.execute("SELECT 1 FROM notes LIMIT 1").fetchone() is None
+
+    def import_state(self, data) -> None:
+        for note in data:
+            self.op_add_note(note)
+
+    def lazy_data(self, obj):
+        return SqlNotes(self, obj._attach)
+
+    def op_add_note(self, note: Note) -> None:
+        cursor = self.connection.execute(
+            "INSERT INTO notes (title, position, text) VALUES (?, ?, ?)",
+            (note.title, self.next_position("notes"), note.text))
+        self.connection.execute(
+            "INSERT INTO notes_fts (rowid, title, text) VALUES (?, ?, ?)", (cursor.lastrowid, note.title, note.text))
+        self.__insert_tags(note)
+
+    def op_edit_note(self, title: str, text: str) -> None:
+        self.connection.execute("UPDATE notes SET text = ? WHERE title = ?", (text, title))
+        self.connection.execute(
+            "UPDATE notes_fts SET text = ? WHERE rowid = (SELECT rowid FROM notes WHERE title = ?)", (text, title))
+        self.connection.execute("DELETE FROM note_tags WHERE title = ?", (title,))
+        self.__insert_tags(Note(title, text))
+
+    def op_delete_note(self, title: str) -> None:
+        self.connection.execute("DELETE FROM notes_fts WHERE rowid = (SELECT rowid FROM notes WHERE title = ?)", (title,))
+        self.connection.execute("DELETE FROM notes WHERE title = ?", (title,))
+
+    def __insert_tags(self, note: Note) -> None:
+        self.connection.executemany(
+            "INSERT INTO note_tags (title, tag, count) VALUES (?, ?, ?)",
+            ((note.title, tag, count) for tag, count in note.tags.items()))
+
+    def load_note(self, title: str) -> Note:
+        row = self.connection.execute("SELECT text FROM notes WHERE title = ?", (title,)).fetchone()
+        return Note(title, row[0]) if row else None
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+
+    def notes(self, offset: int = 0, limit: int = -1):
+        yield from self.connection.execute(
+            "SELECT title, text FROM notes ORDER BY position LIMIT ? OFFSET ?", (limit, offset))
+
+    def all_notes(self, page_size=256):
+        yield from self.paged("SELECT position, title, text FROM notes WHERE position > ? ORDER BY position LIMIT ?", page_size)
+
+    def search_notes(self, terms: list, tags: list) -> list:
+        titles = None
+        if terms:
+            titles = self.__match_terms(terms)
+        if not tags:
+            return list(titles or [])
+        tagged = []
+        for tag in tags:
+            rows = self.connection.execute("""
+                SELECT note_tags.title FROM note_tags JOIN notes ON notes.title = note_tags.title
+                WHERE tag = ? ORDER BY count DESC, position""", (tag,))
+            if titles is None:
+                tagged += [title for title, in rows]
+            else:
+                tagged += sorted((title for title, in rows if title in titles), key=titles.get)
+        return tagged
+
+    def __match_terms(self, terms: list) -> dict:
+        # the trigram tokenizer answers case-insensitive substring queries of three or more characters,
+        # ranked by the built-in bm25(); shorter terms fall back to a scan and rank after them
+        long_terms = [term for term in terms if len(term) >= 3]
+        short_terms = [term for term in terms if len(term) < 3]
+        titles = {}
+        if long_terms:
+            rows = self.connection.execute("""
+                SELECT notes.title FROM notes_fts JOIN notes ON notes.rowid = notes_fts.rowid
+                WHERE notes_fts MATCH ? ORDER BY bm25(notes_fts)""",
+                (" OR ".join('"' + term.replace('"', '""') + '"' for term in long_terms),))
+            for title, in rows:
+                titles.setdefault(title, len(titles))
+        if short_terms:
+            clauses = " OR ".join("instr(pylower(title), ?) OR instr(pylower(text), ?)" for _ in short_terms)
+            rows = self.connection.execute(
+                f"SELECT title FROM notes WHERE {clauses} ORDER BY position", [term for term in short_terms for _ in (0, 1)])
+            for title, in rows:
+                titles.setdefault(title, len(titles))
+        return titles
+
+
+class SqlNotes:
+    lazy = True
+
+    def __init__(self, storage: NotesSqlStorage, on_load) -> None:
+        self.__storage = storage
+        self.__on_load = on_load
+        self.__cache = {}
+
+    def __note(self, title: str, text: str) -> Note:
+        note = self.__cache.get(title)
+        if note is None:
+            note = Note(title, text)
+            self.__on_load(note)
+        return note
+
+    def get(self, title: str) -> Note:
+        note = self.__cache.get(title)
+        if note is None:
+            note = self.__storage.load_note(title)
+            if note is None:
+                return None
+            self.__on_load(note)
+            self.__cache[title] = note
+        return note
+
+    def append(self, note: Note) -> None:
+        self.__cache[note.title] = note
+
+    def invalidate(self) -> None:
+        self.__cache.clear()
+
+    def pop_title(self, title: str) -> Note:
+        note = self.get(title)
+        self.__cache.pop(title, None)
+        return note
+
+    def __len__(self) -> int:
+        return self.__storage.count()
+
+    def __getitem__(self, index: int) -> Note:
+        if index < 0:
+            index += len(self)
+        for title, text in self.__storage.notes(index, 1):
+            return self.__note(title, text)
+        raise IndexError("note index out of range")
+
+    def __iter__(self):
+        return self.scan()
+
+    def scan(self, page_size=256):
+        for title, text in self.__storage.all_notes(page_size):
+            yield self.__note(title, text)
@@ -1,13 +1,109 @@
 import math
-import re
-import itertools as it
-import functools
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+
+def edit_distance(source: str, target: str, limit: int = None) -> int:
+    # optimal string alignment distance: Levenshtein plus adjacent transpositions
+    if limit is not None and abs(len(source) - len(target)) > limit:
+        return limit + 1
+    # a shared prefix or suffix never changes the distance, and trimming it shrinks the table
+    start, shortest = 0, min(len(source), len(target))
+    while start < shortest and source[start] == target[start]:
+        start += 1
+    end = 0
+    while end < shortest - start and source[-1 - end] == target[-1 - end]:
+        end += 1
+    source, target = source[start:len(source) - end], target[start:len(target) - end]
+    previous_row = None
+    row = list(range(len(target) + 1))
+    for i in range(1, len(source) + 1):
+        before_previous, previous_row = previous_row, row
+        row = [i] + [0] * len(target)
+        for j in range(1, len(target) + 1):
+            cost = 0 if source[i - 1] == target[j - 1] else 1
+            row[j] = min(previous_row[j] + 1, row[j - 1] + 1, previous_row[j - 1] + cost)
+            if i > 1 and j > 1 and source[i - 1] == target[j - 2] and source[i - 2] == target[j - 1]:
+                row[j] = min(row[j], before_previous[j - 2] + 1)
+        if limit is not None and min(row) > limit:
+            return limit + 1
+    return row[-1]
+
+
+class DeletionIndex:
+    # symmetric delete index: two words within distance k share a variant
+    # obtained by deleting at most k characters from each of them
+    def __init__(self, max_distance=2) -> None:
+        self.__max_distance = max_distance
+        self.__variants = {}
+
+    def __deletes(self, word: str) -> set:
+        variants = {word}
+        edge = {word}
+        for _ in range(self.__max_distance):
+            edge = {variant[:i] + variant[i + 1:] for variant in edge for i in range(len(variant))}
+            variants |= edge
+        return variants
+
+    def add(self, word: str) -> None:
+        # most variants belong to one word, which is stored bare rather than in a list
+        for variant in self.__deletes(word):
+            words = self.__variants.get(variant)
+            if words is None:
+                self.__variants[variant] = word
+            elif isinstance(words, list):
+                words.append(word)
+            else:
+                self.__variants[variant] = [words, word]
+
+    def remove(self, word: str) -> None:
+        for variant in self.__deletes(word):
+            words = self.__variants.get(variant)
+            if words == word:
+                del self.__variants[variant]
+            elif isinstance(words, list) and word in words:
+                words.remove(word)
+                if len(words) == 1:
+                    self.__variants[variant] = words[0]
+
+    def search(self, word: str, max_distance: int) -> list:
+        candidates = set()
+        for variant in self.__deletes(word):
+            words = self.__variants.get(variant)
+            if isinstance(words, list):
+                candidates.update(words)
+            elif words is not None:
+                candidates.add(words)
+        found = []
+        for candidate in candidates:
+            distance = edit_distance(word, candidate, max_distance)
+            if distance <= max_distance:
+                found.append((distance, candidate))
+        return found
+
 
 class Suggester:
-    def __init__(self, words):
+    def __init__(self, words, cache_size=256, max_prefix_matches=50):
         self.__suggestions = {}
-        for word in words:        
-            self.__suggestions[word] = self.__parse_word(word)
+        self.__anagrams = {}
+        self.__sorted_words = []
+        self.__matcher = DeletionIndex()
+        self.__cache = OrderedDict()
+        self.__cache_lock = threading.Lock()
+        self.__cache_size = cache_size
+        self.__max_prefix_matches = max_prefix_matches
+        for word in sorted(words):
+            self.add(word)
+
+    def add(self, word: str) -> None:
+        if word in self.__suggestions:
+            return
+        self.__suggestions[word] = self.__parse_word(word)
+        self.__anagrams.setdefault("".join(sorted(word)), word)
+        self.__sorted_words.insert(bisect_left(self.__sorted_words, word), word)
+        self.__matcher.add(word)
+        self.__cache.clear()
 
     def __parse_word(self, word, total_length=None):
         chars = []
@@ -15,54 +111,63 @@ class Suggester:
             length = len(wrd)
             last_index = length -1
             weight = 1/total_length if total_length else 1/length
-            chars = [(ch,weight) for ch in wrd]        
-            half = math.ceil(length/2)        
+            chars = [(ch,weight) for ch in wrd]
+            half = math.ceil(length/2)
             for i in range(half):
                 boost = 1 - i * 0.1
                 left = list(chars[i])
                 right = list(chars[last_index-i])
                 left[1] *= boost
-                right[1] *= boost     
+                right[1] *= boost
                 chars[i] = tuple(left)
                 chars[last_index-i] = tuple(right)
         return chars
 
     def suggest(self, word):
-        chars = self.__parse_word(word)
-        typo_solved = self.__resolve_typo(chars)
+        with self.__cache_lock:
+            if word in self.__cache:
+                self.__cache.move_to_end(word)
+                return self.__cache[word]
+        suggestion = self.__suggest(word)
+        with self.__cache_lock:
+            self.__cache[word] = suggestion
+            if len(self.__cache) > self.__cache_size:
+                self.__cache.popitem(last=False)
+        return suggestion
+
+    def __suggest(self, word):
+        typo_solved = self.__anagrams.get("".join(sorted(word)))
         if typo_solved:
-            return typo_solved        
-        matches = {}
-        for sug_wrd in self.__suggestions.keys():
-            mtch = self.__get_best_match(word, sug_wrd)
-            if mtch:
-                matches[mtch[0]] = mtch[1]
-        result = {self.__rate_suggestion(chars, sug_chrs):sug_wrd for sug_wrd, sug_chrs in (matches.items() if matches else self.__suggestions.items())}
-        #print(dict(sorted(result.items(),reverse=True)))
-        return result[max(result.keys())]
-
-    def __resolve_typo(self, chars):    
-        sorted_chars = sorted(map(lambda ch: ch[0], chars))
-        for sug_wrd, sug_chrs in self.__suggestions.items():
-            if sorted(map(lambda ch: ch[0], sug_chrs)) == sorted_chars:
-                return sug_wrd
-
-    def __get_best_match(self, word, suggestion) -> tuple:
-        part, full = (word, suggestion) if len(word) < len(suggestion) else (suggestion, word)        
-        if part in full:
-            return (suggestion, self.__parse_word(part, len(full)))
-        return None
+            return typo_solved
+        max_distance = 1 if len(word) <= 4 else 2
+        matches = dict((candidate, distance) for distance, candidate in self.__matcher.search(word, max_distance))
+        for candidate in self.__prefix_matches(word):
+            matches.setdefault(candidate, len(candidate) - len(word))
+        if not matches:
+            return None
+        chars = self.__parse_word(word)
+        ranked = sorted(matches.items(), key=lambda match: (match[1], -self.__rate_suggestion(chars, self.__suggestions[match[0]]), match[0]))
+        return ranked[0][0]
 
+    def __prefix_matches(self, word) -> list:
+        if len(word) < 2:
+            return []
+        start = bisect_left(self.__sorted_words, word)
+        matches = []
+        for candidate in self.__sorted_words[start:start + self.__max_prefix_matches]:
+            if not candidate.startswith(word):
+                break
+            matches.append(candidate)
+        return matches
 
     def __rate_suggestion(self, chars, suggestion):
-        rate_left = 0.0  
-        rate_right = 0.0  
+        rate_left = 0.0
+        rate_right = 0.0
         last_index_chars = len(chars) - 1
-        last_index_suggestion = len(suggestion) - 1    
+        last_index_suggestion = len(suggestion) - 1
         for i in range(min(len(chars),len(suggestion))):
-            if chars[i][0] == suggestion[i][0]:            
+            if chars[i][0] == suggestion[i][0]:
                 rate_left += min(chars[i][1], suggestion[i][1])
             if chars[last_index_chars - i][0] == suggestion[last_index_suggestion - i][0]:
                 rate_right += min(chars[last_index_chars - i][1], suggestion[last_index_suggestion - i][1])
         return max(rate_left, rate_right)
-